@@ -1,27 +1,67 @@
+import pickle
 import torch
 import numpy as np
 
-class LinearPolicy(torch.nn.Module):
+from parameter_logging import writeParameterSummaries
+
+POLICY_CLASSES = ("LinearPolicy", "NonlinearPolicy", "TwoLayerNLP", "ExpertMixturePolicy")
+
+
+class Policy(torch.nn.Module):
+    """
+    Common interface of all policies.
+    Subclasses implement batchForward, which maps a batch of states (B, d_in) to gating weights (B, num_experts)
+    and expert inputs (B, num_experts, d_out). Calling the policy with a single state (d_in,) returns the
+    corresponding unbatched tensors (num_experts,) and (num_experts, d_out).
+    """
+
+    def forward(self, tx):
+        if tx.dim() == 1:
+            p, u = self.batchForward(tx.unsqueeze(0))
+            return p[0], u[0]
+        return self.batchForward(tx)
+
+    def action(self, tx):
+        """Gating-weighted mixture of the expert inputs, (d_out,) for a single state or (B, d_out) for a batch."""
+        p, u = self(tx)
+        return torch.matmul(p.unsqueeze(-2), u).squeeze(-2)
+
+    def logParameters(self, writer, it):
+        writeParameterSummaries(writer, self.named_parameters(prefix=self.log_prefix, recurse=True), it)
+
+    def freeze(self):
+        """NumPy-only FrozenPolicy with a copy of the current weights, for the single state control loops."""
+        return FrozenPolicy(self.d_out, [_frozenLinear(layer) for layer in self.frozenTrunk()], *self.frozenHeads())
+
+
+class LinearPolicy(Policy):
+    log_prefix = 'LinearPolicy'
+
     def __init__(self, d_in, d_out):
         super(LinearPolicy, self).__init__()
+        self.d_in = d_in
         self.d_out = d_out
         self.linear = torch.nn.Linear(d_in, d_out)
 
 
-    def forward(self, tx):
-        u = self.linear(tx).reshape((1, self.d_out))
-        return torch.ones((1, 1)), u
+    def batchForward(self, tx):
+        u = self.linear(tx).reshape((-1, 1, self.d_out))
+        return torch.ones((tx.shape[0], 1), dtype=tx.dtype, device=tx.device), u
 
-    def logParameters(self, writer, it):
-        for param in list(self.named_parameters(prefix='LinearPolicy', recurse=True)):
-            for scalar_it in range(len(param[1].data.view(-1))):
-                writer.add_scalar(param[0] + "/" + str(scalar_it), param[1].data.view(-1)[scalar_it].item(), it)
+    def frozenTrunk(self):
+        return []
+
+    def frozenHeads(self):
+        return _frozenLinear(self.linear), None
 
 
-class NonlinearPolicy(torch.nn.Module):
+class NonlinearPolicy(Policy):
+    log_prefix = 'NonlinearPolicy'
+
     def __init__(self, d_in, d_out):
         super(NonlinearPolicy, self).__init__()
 
+        self.d_in = d_in
         self.d_out  = d_out
         self.n_hidden = d_in * 2 * 2
 
@@ -31,21 +71,25 @@ class NonlinearPolicy(torch.nn.Module):
         self.activation2 = torch.tanh
         self.linear3 = torch.nn.Linear(self.n_hidden, self.d_out)
 
-    def forward(self, tx):
+    def batchForward(self, tx):
         z_h1 = self.activation1(self.linear1(tx))
-        u = self.linear3(z_h1).reshape((1, self.d_out))
-        return torch.ones((1, 1)), u
+        u = self.linear3(z_h1).reshape((-1, 1, self.d_out))
+        return torch.ones((tx.shape[0], 1), dtype=tx.dtype, device=tx.device), u
+
+    def frozenTrunk(self):
+        return [self.linear1]
+
+    def frozenHeads(self):
+        return _frozenLinear(self.linear3), None
 
-    def logParameters(self, writer, it):
-        for param in list(self.named_parameters(prefix='NonlinearPolicy', recurse=True)):
-            for scalar_it in range(len(param[1].data.view(-1))):
-                writer.add_scalar(param[0] + "/" + str(scalar_it), param[1].data.view(-1)[scalar_it].item(), it)
 
+class TwoLayerNLP(Policy):
+    log_prefix = 'TwoLayerNLP'
 
-class TwoLayerNLP(torch.nn.Module):
     def __init__(self, d_in, d_out):
         super(TwoLayerNLP, self).__init__()
 
+        self.d_in = d_in
         self.d_out  = d_out
         self.n_hidden = 128
 
@@ -55,24 +99,28 @@ class TwoLayerNLP(torch.nn.Module):
         self.activation2 = torch.tanh
         self.linear3 = torch.nn.Linear(self.n_hidden, self.d_out)
 
-    def forward(self, tx):
+    def batchForward(self, tx):
         z_h1 = self.activation1(self.linear1(tx))
         z_h2 = self.activation2(self.linear2(z_h1))
-        u = self.linear3(z_h2).reshape((1, self.d_out))
-        return torch.ones((1, 1)), u
+        u = self.linear3(z_h2).reshape((-1, 1, self.d_out))
+        return torch.ones((tx.shape[0], 1), dtype=tx.dtype, device=tx.device), u
 
-    def logParameters(self, writer, it):
-        for param in list(self.named_parameters(prefix='TwoLayerNLP', recurse=True)):
-            for scalar_it in range(len(param[1].data.view(-1))):
-                writer.add_scalar(param[0] + "/" + str(scalar_it), param[1].data.view(-1)[scalar_it].item(), it)
+    def frozenTrunk(self):
+        return [self.linear1, self.linear2]
+
+    def frozenHeads(self):
+        return _frozenLinear(self.linear3), None
 
 
-class ExpertMixturePolicy(torch.nn.Module):
+class ExpertMixturePolicy(Policy):
+    log_prefix = 'ExpertMixPolicy'
+
     def __init__(self, d_in, d_out):
         super(ExpertMixturePolicy, self).__init__()
 
         self.num_experts = 8
         self.n_hidden = d_in * 4
+        self.d_in = d_in
         self.d_out = d_out
 
         self.linear1 = torch.nn.Linear(d_in, self.n_hidden)
@@ -88,16 +136,113 @@ class ExpertMixturePolicy(torch.nn.Module):
             torch.nn.Linear(self.n_hidden, d_out*self.num_experts)
         )
 
-    def forward(self, tx):
+    def batchForward(self, tx):
         z_h = self.activation1(self.linear1(tx))
         pi_nonNormalized = self.selector_net(z_h)
-        pi = pi_nonNormalized / pi_nonNormalized.sum()
+        pi = pi_nonNormalized / pi_nonNormalized.sum(dim=-1, keepdim=True)
 
-        u_experts = self.expert_net(z_h).reshape((self.num_experts, self.d_out))
+        u_experts = self.expert_net(z_h).reshape((-1, self.num_experts, self.d_out))
 
         return pi, u_experts
 
-    def logParameters(self, writer, it):
-        for param in list(self.named_parameters(prefix='ExpertMixPolicy', recurse=True)):
-            for scalar_it in range(len(param[1].data.view(-1))):
-                writer.add_scalar(param[0]+"/"+str(scalar_it), param[1].data.view(-1)[scalar_it].item(), it)
+    def frozenTrunk(self):
+        return [self.linear1]
+
+    def frozenHeads(self):
+        return _frozenLinear(self.expert_net[0]), _frozenLinear(self.selector_net[0])
+
+
+def _frozenLinear(layer):
+    return (layer.weight.detach().cpu().numpy().astype(np.float64),
+            layer.bias.detach().cpu().numpy().astype(np.float64))
+
+
+class FrozenPolicy(object):
+    """
+    Inference-only copy of a policy in NumPy: tanh trunk layers followed by an expert head and an optional
+    sigmoid gating head. Gating normalization and expert mixing are fused into one weighted sum, and every
+    intermediate result is written into preallocated buffers, so a control step allocates nothing.
+    Write the state into `input` and call evaluate(), or pass it to __call__. The returned input array is
+    a buffer that the next call overwrites.
+    """
+
+    def __init__(self, d_out, trunk, expert_head, gate_head=None):
+        self.trunk = trunk
+        self.expert_head = expert_head
+        self.gate_head = gate_head
+        self.num_experts = expert_head[0].shape[0] // d_out
+        self.input = np.zeros((trunk[0][0] if trunk else expert_head[0]).shape[1])
+        self.hidden = [np.zeros(W.shape[0]) for W, _ in trunk]
+        self.experts = np.zeros((self.num_experts, d_out))
+        self.gate = np.zeros(self.num_experts)
+        self.output = np.zeros(d_out)
+
+    def evaluate(self):
+        z = self.input
+        for (W, b), h in zip(self.trunk, self.hidden):
+            np.dot(W, z, out=h)
+            h += b
+            np.tanh(h, out=h)
+            z = h
+
+        W, b = self.expert_head
+        experts = self.experts.reshape(-1)
+        np.dot(W, z, out=experts)
+        experts += b
+        if self.gate_head is None:
+            self.output[:] = self.experts[0]
+            return self.output
+
+        W, b = self.gate_head
+        np.dot(W, z, out=self.gate)
+        self.gate += b
+        # sigmoid, then fold the normalization into the mixing weights
+        np.negative(self.gate, out=self.gate)
+        np.exp(self.gate, out=self.gate)
+        self.gate += 1.0
+        np.reciprocal(self.gate, out=self.gate)
+        self.gate /= self.gate.sum()
+        np.dot(self.gate, self.experts, out=self.output)
+        return self.output
+
+    def __call__(self, tx):
+        self.input[:] = tx
+        return self.evaluate()
+
+
+def policySnapshot(policy):
+    """Picklable description of a policy: its class name, dimensions and a CPU copy of its weights."""
+    return {"class": type(policy).__name__, "d_in": policy.d_in, "d_out": policy.d_out,
+            "state_dict": {name: tensor.detach().cpu().clone() for name, tensor in policy.state_dict().items()}}
+
+
+def policyFromSnapshot(snapshot):
+    policy = globals()[snapshot["class"]](snapshot["d_in"], snapshot["d_out"])
+    policy.load_state_dict(snapshot["state_dict"])
+    return policy
+
+
+def loadPolicy(path, policy_class=None, d_in=None, d_out=None):
+    """
+    Loads a checkpoint written from a policySnapshot, a bare state_dict or a whole pickled policy module
+    as saved by older versions.
+    :param policy_class: Class or class name of the policy, only needed for bare state_dicts
+    :param d_in: Input dimension of the policy, only needed for bare state_dicts
+    :param d_out: Output dimension of the policy, only needed for bare state_dicts
+    """
+    try:
+        checkpoint = torch.load(path, map_location="cpu")
+    except pickle.UnpicklingError:
+        # recent torch versions refuse to unpickle modules unless explicitly asked to
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if isinstance(checkpoint, dict) and "state_dict" not in checkpoint:
+        if policy_class is None or d_in is None or d_out is None:
+            raise ValueError(path + " holds a bare state_dict, its policy class and dimensions are required")
+        if isinstance(policy_class, str):
+            policy_class = globals()[policy_class]
+        checkpoint = {"class": policy_class.__name__, "d_in": d_in, "d_out": d_out, "state_dict": checkpoint}
+    if isinstance(checkpoint, dict):
+        return policyFromSnapshot(checkpoint)
+    if not hasattr(checkpoint, "d_in"):  # modules pickled before the input dimension was stored
+        checkpoint.d_in = next(checkpoint.parameters()).shape[1]
+    return checkpoint
@@ -0,0 +1,105 @@
+import queue
+import time
+import traceback
+import torch
+from tensorboardX import SummaryWriter
+
+from ballbot_evaluation import trajectoryCost
+from mpc_collection import initWorkerProcess, workerContext
+from PolicyNet import policySnapshot, policyFromSnapshot
+from training_state import atomicWrite
+
+
+def saveCheckpoint(snapshot, path):
+    atomicWrite(path, lambda tmp_path: torch.save(snapshot, tmp_path))
+
+
+def _evaluationWorker(request_queue, logdir, duration, dt_control, numStartingPoints):
+    mpc = initWorkerProcess()
+    writer = SummaryWriter(logdir)
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        it, snapshot, evaluate, checkpoint_path = request
+        try:
+            if checkpoint_path is not None:
+                print("Iteration", it, "saving policy to", checkpoint_path)
+                saveCheckpoint(snapshot, checkpoint_path)
+            if evaluate:
+                policy = policyFromSnapshot(snapshot)
+                oc_cost, survival_time, survival_fraction = trajectoryCost(
+                    mpc, policy=policy, duration=duration, dt_control=dt_control, numStartingPoints=numStartingPoints)
+                writer.add_scalar('metric/oc_cost', oc_cost, it)
+                writer.add_scalar('metric/survival_time', survival_time, it)
+                writer.add_scalar('metric/survival_fraction', survival_fraction, it)
+                print("iteration", it, "oc_cost", oc_cost, "survival_fraction", survival_fraction)
+        except Exception:  # one failed snapshot must not end the evaluation of the rest of the run
+            print("Evaluator failed on the snapshot of iteration", it)
+            traceback.print_exc()
+    writer.close()
+
+
+class BackgroundEvaluator(object):
+    """
+    Computes the cost metrics of policy snapshots, writes checkpoints and logs to TensorBoard in a separate
+    process with its own mpc_interface, so that the optimizer does not stall.
+    Snapshots are handed over through a bounded queue. If the evaluator falls behind, the oldest pending
+    snapshot is dropped in favour of the newest one, which then also takes over its pending checkpoint.
+    """
+
+    def __init__(self, logdir, duration, dt_control, numStartingPoints=1, max_pending=1):
+        ctx = workerContext()
+        self.request_queue = ctx.Queue(maxsize=max_pending)
+        self.process = ctx.Process(target=_evaluationWorker,
+                                   args=(self.request_queue, logdir, duration, dt_control, numStartingPoints),
+                                   daemon=True)
+        self.process.start()
+        self.warned_dead = False
+
+    def submit(self, it, policy, evaluate=True, checkpoint_path=None):
+        """
+        Hands a snapshot of the current policy weights to the evaluator without waiting for it.
+        If the evaluator has exited, the checkpoint is written inline instead and the evaluation is skipped.
+        :return: False if a pending, older snapshot or the evaluation had to be dropped
+        """
+        if not self.process.is_alive():
+            if not self.warned_dead:
+                print("Warning: evaluator exited with code", self.process.exitcode,
+                      "see its output, checkpoints are now saved inline and evaluations skipped")
+                self.warned_dead = True
+            if checkpoint_path is not None:
+                print("Iteration", it, "saving policy to", checkpoint_path)
+                saveCheckpoint(policySnapshot(policy), checkpoint_path)
+            return not evaluate
+        request = (it, policySnapshot(policy), evaluate, checkpoint_path)
+        dropped = False
+        while True:
+            try:
+                self.request_queue.put_nowait(request)
+                return not dropped
+            except queue.Full:
+                pass
+            try:
+                stale_it, _, stale_evaluate, stale_checkpoint_path = self.request_queue.get_nowait()
+            except queue.Empty:
+                continue  # the evaluator just took it
+            dropped = True
+            print("Evaluator is behind, dropping snapshot of iteration", stale_it)
+            if checkpoint_path is None:
+                checkpoint_path = stale_checkpoint_path
+            request = (it, request[1], evaluate or stale_evaluate, checkpoint_path)
+
+    def close(self, timeout=60.0):
+        """Finishes the pending requests and stops the evaluator, which is killed if it takes longer than timeout."""
+        deadline = time.time() + timeout
+        if self.process.is_alive():
+            try:
+                self.request_queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        self.process.join(max(deadline - time.time(), 0.0))
+        if self.process.is_alive():
+            print("Evaluator did not finish within", timeout, "s, killing it")
+            self.process.kill()
+            self.process.join()
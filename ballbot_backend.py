@@ -0,0 +1,18 @@
+"""
+Selects the implementation behind mpc_interface and its container types.
+By default the OCS2 python bindings are used. Setting the environment variable MPCNET_BACKEND=local
+switches to the NumPy stand-in in ballbot_local.py, which needs no OCS2 build.
+"""
+import os
+import sys
+
+backend = os.environ.get("MPCNET_BACKEND", "ocs2")
+
+if backend == "ocs2":
+    # ugly workaround until shared library can be discovered properly with python3
+    sys.path.append(os.environ["HOME"]+"/catkin_ws/devel/lib/python3.6/dist-packages/ocs2_ballbot_example")
+    from BallbotPyBindings import mpc_interface, scalar_array, state_vector_array, input_vector_array, dynamic_vector_array, cost_desired_trajectories
+elif backend == "local":
+    from ballbot_local import mpc_interface, scalar_array, state_vector_array, input_vector_array, dynamic_vector_array, cost_desired_trajectories
+else:
+    raise ValueError("Unknown MPCNET_BACKEND '" + backend + "', expected 'ocs2' or 'local'")
@@ -1,49 +1,145 @@
+"""
+Evaluation of trained policies on the internal model.
+
+Plots a single checkpoint with
+    python3 ballbot_evaluation.py --plot /tmp/mpcPolicy_<date>.pt
+or evaluates checkpoints and directories of checkpoints headless and in parallel, writing one JSON line of
+cost metrics per checkpoint and optionally the decimated rollouts as .rollout files, e.g.
+    python3 ballbot_evaluation.py /tmp --processes 8 --summary sweep.jsonl --rollout-dir rollouts
+"""
+import argparse
+import glob
+import json
+import os
+import sys
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
-import os
-
-import sys
-sys.path.append(os.environ["HOME"]+"/catkin_ws/devel/lib/python3.6/dist-packages/ocs2_ballbot_example")
-
-from BallbotPyBindings import mpc_interface, scalar_array, state_vector_array, input_vector_array, dynamic_vector_array, cost_desired_trajectories
-
-mpc = mpc_interface("mpc", False)
 
-
-def plot(save_path, t_end=10.0):
-    policy = torch.load(save_path)
+from ballbot_backend import mpc_interface
+from mpc_collection import getTargetTrajectories, initWorkerProcess, workerContext
+from PolicyNet import loadPolicy
+from simulator import Simulator, intermediateCostBatch, INTEGRATORS
+
+
+def evaluationStartStates(mpc, numStartingPoints, seed=0):
+    """
+    Fixed set of initial states for the cost metrics, the equilibrium followed by random base positions.
+    :return: (numStartingPoints, STATE_DIM) array
+    """
+    rng = np.random.RandomState(seed)
+    x0 = np.zeros((numStartingPoints, mpc.STATE_DIM))
+    x0[1:, 0:2] = rng.uniform(-0.5, 0.5, size=(numStartingPoints - 1, 2)) # base x, base y
+    return x0
+
+
+def rolloutCosts(mpc, policy, x0, duration, dt_control, dtype=torch.float, device=torch.device("cpu"),
+                 integrator="euler", substeps=1, rolloutWriter=None, decimation=1):
+    """
+    Rolls out the policy from all initial states x0 (K, STATE_DIM) in lockstep in a Simulator.
+    Rollouts whose cost or state becomes non-finite are masked and stop accumulating cost.
+    :param rolloutWriter: Optional RolloutWriter receiving the time, states and inputs of every decimation-th step
+    :return: Accumulated cost (K,) and survival time (K,) of every rollout
+    """
+    simulator = Simulator(mpc, x0, dt_control, integrator=integrator, substeps=substeps)
+    cost = np.zeros(len(x0))
+    survival_time = np.full(len(x0), duration)
+    alive = np.ones(len(x0), dtype=bool)
+    for it in range(int(duration / dt_control)):
+        with torch.no_grad():
+            u = policy.action(torch.tensor(simulator.tx, dtype=dtype, device=device))
+        u_np = u.cpu().numpy().astype('float64')
+        if rolloutWriter is not None and it % decimation == 0:
+            rolloutWriter.write(simulator.tx, u_np)
+        rows = np.flatnonzero(alive)
+        t_start = simulator.t[rows]
+        L = intermediateCostBatch(mpc, t_start, simulator.x[rows], u_np[rows])
+        simulator.step(u_np, alive)
+        diverged = ~(np.isfinite(L) & np.all(np.isfinite(simulator.x[rows]), axis=1))
+        alive[rows[diverged]] = False
+        survival_time[rows[diverged]] = t_start[diverged]
+        cost[rows[~diverged]] += L[~diverged]
+        if not alive.any():
+            break
+    return cost, survival_time
+
+
+def trajectoryCost(mpc, policy, duration, dt_control, numStartingPoints=1, dtype=torch.float,
+                   device=torch.device("cpu"), integrator="euler", substeps=1, rolloutWriter=None, decimation=1):
+    """
+    :return: Mean cost over all rollouts, nan if any of them diverged, the mean survival time and the fraction
+             of rollouts that survived the whole duration
+    """
+    x0 = evaluationStartStates(mpc, numStartingPoints)
+    cost, survival_time = rolloutCosts(mpc, policy, x0, duration, dt_control, dtype, device, integrator, substeps,
+                                       rolloutWriter, decimation)
+    survived = survival_time >= duration
+    # a diverged rollout has no finite cost, averaging over the survivors only would favour unstable policies
+    mean_cost = cost.mean() if survived.all() else np.nan
+    return mean_cost, survival_time.mean(), survived.mean()
+
+
+class RolloutWriter(object):
+    """
+    Streams the rows (t, x, u) of K lockstep rollouts to a file in bounded memory. Rows are buffered in a
+    preallocated (chunk_rows, K, 1 + STATE_DIM + INPUT_DIM) array, which is appended to the file with
+    np.save whenever it is full. The file is a sequence of .npy chunks, of which np.load only reads the first,
+    readRollout() reassembles all of them.
+    """
+
+    def __init__(self, path, num_rollouts, state_dim, input_dim, chunk_rows=1000):
+        self.rolloutFile = open(path, 'wb')
+        self.chunk = np.empty((chunk_rows, num_rollouts, 1 + state_dim + input_dim))
+        self.state_dim = state_dim
+        self.num_rows = 0
+
+    def write(self, tx, u):
+        self.chunk[self.num_rows, :, :1 + self.state_dim] = tx
+        self.chunk[self.num_rows, :, 1 + self.state_dim:] = u
+        self.num_rows += 1
+        if self.num_rows == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        if self.num_rows > 0:
+            np.save(self.rolloutFile, self.chunk[:self.num_rows])
+            self.num_rows = 0
+
+    def close(self):
+        self.flush()
+        self.rolloutFile.close()
+
+
+def readRollout(path):
+    """:return: (T, K, 1 + STATE_DIM + INPUT_DIM) array of all chunks written by a RolloutWriter"""
+    chunks = []
+    with open(path, 'rb') as rolloutFile:
+        while rolloutFile.peek(1):
+            chunks.append(np.load(rolloutFile))
+    return np.concatenate(chunks)
+
+
+def plot(mpc, save_path, t_end=10.0):
+    policy = loadPolicy(save_path)
 
     dt = 1./400.
-    tx0 = np.zeros((mpc.STATE_DIM + 1, 1))
-    tx0[1, 0] = -0.5
-    tx0[2, 0] = 0.5
-
-    tx_history = np.zeros((int(t_end/dt)+1, mpc.STATE_DIM + 1))
+    x0 = np.zeros(mpc.STATE_DIM)
+    x0[0] = -0.5
+    x0[1] = 0.5
 
-    tx = tx0
-    average_constraint_violation = 0
     steps = int(t_end/dt)
+    simulator = Simulator(mpc, x0, dt, history_length=steps + 1)
 
+    frozen_policy = policy.freeze()
     for it in range(steps):
-        tx_history[it, :] = np.transpose(tx)
-        tx_torch = torch.tensor(np.transpose(tx), dtype=torch.float, requires_grad=False)
-        tx_torch[0][0] = 0.0 #optionally run it in MPC style
-
-        p, u_pred = policy(tx_torch)
-        if len(p) > 1:
-            u = torch.mm(p.t(), u_pred)
-        else:
-            u = u_pred[0]
+        frozen_policy.input[:] = simulator.tx[0]
+        frozen_policy.input[0] = 0.0 #optionally run it in MPC style
 
-        u_np = u.t().detach().numpy().astype('float64')
+        u_np = frozen_policy.evaluate()
 
-        dx = mpc.computeFlowMap(tx[0], tx[1:], u_np)
+        simulator.step(u_np)
 
-        np.transpose(tx[1:])[0] += dx*dt
-        tx[0] += dt
-
-    tx_history[it+1,:] = np.transpose(tx)
+    tx_history = simulator.history()[:, 0]
 
     plt.figure(figsize=(8, 8))
     lineObjects = plt.plot(tx_history[:, 0], tx_history[:, 1:6])
@@ -51,6 +147,102 @@ def plot(save_path, t_end=10.0):
 
 
 
-
-plot(save_path="/path/to/saved/policy.pt", t_end=10.0)
-plt.show()
+_worker_mpc = None
+
+
+def _initEvaluationWorker():
+    global _worker_mpc
+    # Pool.terminate() stops the workers with SIGTERM
+    _worker_mpc = initWorkerProcess(ignore_sigterm=False)
+
+
+def evaluateCheckpoint(path, args):
+    """Computes the cost metrics of one checkpoint, streaming its rollouts to args.rollout_dir if given."""
+    mpc = _worker_mpc
+    policy = loadPolicy(path, args.policy_class, mpc.STATE_DIM + 1, mpc.INPUT_DIM)
+    policy.eval()
+    rolloutWriter = None
+    result = {"checkpoint": path}
+    if args.rollout_dir is not None:
+        result["rollout"] = os.path.join(args.rollout_dir, os.path.splitext(os.path.basename(path))[0] + ".rollout")
+        rolloutWriter = RolloutWriter(result["rollout"], args.starting_points, mpc.STATE_DIM, mpc.INPUT_DIM,
+                                      args.chunk_rows)
+    try:
+        oc_cost, survival_time, survival_fraction = trajectoryCost(mpc, policy, args.duration, args.dt, args.starting_points,
+                                                integrator=args.integrator, substeps=args.substeps,
+                                                rolloutWriter=rolloutWriter, decimation=args.decimation)
+    finally:
+        if rolloutWriter is not None:
+            rolloutWriter.close()
+    result.update({"oc_cost": None if np.isnan(oc_cost) else float(oc_cost), "survival_time": float(survival_time),
+                   "survival_fraction": float(survival_fraction)})
+    return result
+
+
+def _evaluateCheckpoint(task):
+    path, args = task
+    try:
+        return evaluateCheckpoint(path, args)
+    except Exception as error:  # a broken checkpoint must not end an overnight sweep
+        return {"checkpoint": path, "error": repr(error)}
+
+
+def checkpointPaths(paths, pattern="*.pt"):
+    """Expands directories to the checkpoints matching pattern inside them."""
+    checkpoints = []
+    for path in paths:
+        if os.path.isdir(path):
+            checkpoints.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            checkpoints.append(path)
+    return checkpoints
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoints", nargs="+", help="checkpoint files or directories containing them")
+    parser.add_argument("--pattern", default="*.pt", help="checkpoints taken from directories")
+    parser.add_argument("--plot", action="store_true", help="plot a rollout of every checkpoint instead")
+    parser.add_argument("--policy-class", default="ExpertMixturePolicy", help="policy class of bare state_dicts")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per rollout")
+    parser.add_argument("--dt", type=float, default=1.0 / 400.0, help="control interval")
+    parser.add_argument("--starting-points", type=int, default=24, help="initial states rolled out per checkpoint")
+    parser.add_argument("--integrator", default="euler", choices=INTEGRATORS)
+    parser.add_argument("--substeps", type=int, default=1)
+    parser.add_argument("--rollout-dir", help="stream the rollouts to <checkpoint>.rollout in this directory")
+    parser.add_argument("--decimation", type=int, default=10, help="control steps per streamed rollout row")
+    parser.add_argument("--chunk-rows", type=int, default=1000, help="rows buffered before a chunk is written")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--summary", help="append the JSON lines to this file instead of writing them to stdout")
+    args = parser.parse_args()
+    checkpoints = checkpointPaths(args.checkpoints, args.pattern)
+    if not checkpoints:
+        print("No checkpoints found in", " ".join(args.checkpoints), "matching", args.pattern, file=sys.stderr)
+        return 1
+
+    if args.plot:
+        mpc = mpc_interface("mpc", False)
+        mpc.reset(getTargetTrajectories(mpc))
+        for path in checkpoints:
+            plot(mpc, save_path=path, t_end=args.duration)
+        plt.show()
+        return
+
+    if args.rollout_dir is not None:
+        os.makedirs(args.rollout_dir, exist_ok=True)
+    summaryFile = open(args.summary, 'a') if args.summary else sys.stdout
+    pool = workerContext().Pool(min(args.processes, len(checkpoints)), _initEvaluationWorker)
+    try:
+        for result in pool.imap_unordered(_evaluateCheckpoint, [(path, args) for path in checkpoints]):
+            summaryFile.write(json.dumps(result) + "\n")
+            summaryFile.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+    pool.join()
+    if summaryFile is not sys.stdout:
+        summaryFile.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
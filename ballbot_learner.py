@@ -1,231 +1,65 @@
+import argparse
 import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 import datetime
-import time
-import pickle
-from replay_memory import ReplayMemory
 import os
+import signal
+import time
+from replay_memory import ReplayMemory, PrioritizedReplayMemory
+from batch_prefetcher import BatchPrefetcher
 
-# ugly workaround until shared library can be discovered properly with python3
-import sys
-sys.path.append(os.environ["HOME"]+"/catkin_ws/devel/lib/python3.6/dist-packages/ocs2_ballbot_example")
-
-from BallbotPyBindings import mpc_interface, scalar_array, state_vector_array, input_vector_array, dynamic_vector_array, cost_desired_trajectories
+from ballbot_backend import mpc_interface
 
 from PolicyNet import ExpertMixturePolicy as PolicyNet
+from PolicyNet import loadPolicy, policySnapshot
+from mpc_collection import getTargetTrajectories, CollectionEngine, CollectionWorkers
+from ballbot_losses import Hamiltonian, batch_loss_function, toNumpy, topKExperts, expertLoadImbalance
+from background_evaluation import BackgroundEvaluator, saveCheckpoint
+from parameter_logging import ParameterLogger
+from data_parallel import DataParallelLoss
+from training_state import saveTrainingState, loadTrainingState
+import profiling
+
+parser = argparse.ArgumentParser(description="Trains an MPC-Net policy for the ballbot.")
+parser.add_argument("--resume", metavar="TRAINING_STATE",
+                    help="continue from the training state written by an earlier run, e.g. /tmp/mpcTrainingState")
+args = parser.parse_args()
 
 mpc = mpc_interface("mpc", False)
 systemHasConstraints = False
+constraintDim = 0  # dimension of g1, only used if systemHasConstraints
 
-def getTargetTrajectories():
-    desiredTimeTraj = scalar_array()
-    desiredTimeTraj.resize(1)
-    desiredTimeTraj[0] = 2.0
-
-    desiredInputTraj = dynamic_vector_array()
-    desiredInputTraj.resize(1)
-    desiredInputTraj[0] = np.zeros((mpc.INPUT_DIM, 1))
-
-    desiredStateTraj = dynamic_vector_array()
-    desiredStateTraj.resize(1)
-    desiredStateTraj[0] = np.zeros((mpc.STATE_DIM, 1))
-
-    return cost_desired_trajectories(desiredTimeTraj, desiredStateTraj, desiredInputTraj)
-
-
-targetTrajectories = getTargetTrajectories()
+targetTrajectories = getTargetTrajectories(mpc)
 
 mpc.reset(targetTrajectories)
 
 
 
-dtype = torch.float
+float64_training = False  # policy, replay memory and losses in float64, tensors then share memory with the bindings' numpy arrays
+dtype = torch.float64 if float64_training else torch.float
 device = torch.device("cpu")
 #device = torch.device("cuda:0") # Uncomment this to run on GPU
 
 
 
-class FlowMap(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, t, x, u):
-        """
-        In the forward pass we receive a Tensor containing the input and return
-        a Tensor containing the output. ctx is a context object that can be used
-        to stash information for backward computation. You can cache arbitrary
-        objects for use in the backward pass using the ctx.save_for_backward method.
-        """
-        x_cpu = x.cpu()
-        u_cpu = u.cpu()
-        ctx.save_for_backward(t, x_cpu, u_cpu)
-        x_np = x_cpu.t().detach().numpy().astype('float64')
-        u_np = u_cpu.t().detach().numpy().astype('float64')
-        xDot = torch.tensor(mpc.computeFlowMap(t, x_np, u_np), device=device, dtype=dtype)
-        return xDot
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        """
-        In the backward pass we receive a Tensor containing the gradient of the loss
-        with respect to the output, and we need to compute the gradient of the loss
-        with respect to the input.
-        """
-        grad_t = grad_x = grad_u = None
-        t, x, u = ctx.saved_tensors
-        x_np = x.t().detach().numpy().astype('float64')
-        u_np = u.t().detach().numpy().astype('float64')
-
-        if ctx.needs_input_grad[0]:
-            raise NotImplementedError("Derivative of dynamics w.r.t. time not available")
-        if ctx.needs_input_grad[1]:
-            mpc.setFlowMapDerivativeStateAndControl(t, x_np, u_np)
-            dfdx = torch.tensor(mpc.computeFlowMapDerivativeState(), device=device, dtype=dtype)
-            grad_x = torch.matmul(grad_output, dfdx).reshape((-1, x_np.size))
-        if ctx.needs_input_grad[2]:
-            mpc.setFlowMapDerivativeStateAndControl(t, x_np, u_np)
-            dfdu = torch.tensor(mpc.computeFlowMapDerivativeInput(), device=device, dtype=dtype)
-            grad_u = torch.matmul(grad_output, dfdu).reshape((-1, u_np.size))
-        return grad_t, grad_x, grad_u
-
-
-class IntermediateCost(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, t, x, u):
-        """
-        In the forward pass we receive a Tensor containing the input and return
-        a Tensor containing the output. ctx is a context object that can be used
-        to stash information for backward computation. You can cache arbitrary
-        objects for use in the backward pass using the ctx.save_for_backward method.
-        """
-        x_cpu = x.cpu()
-        u_cpu = u.cpu()
-        ctx.save_for_backward(t, x_cpu, u_cpu)
-        x_np = x_cpu.t().detach().numpy().astype('float64')
-        u_np = u_cpu.t().detach().numpy().astype('float64')
-        L = torch.tensor(mpc.getIntermediateCost(t, x_np, u_np), device=device, dtype=dtype)
-        return L
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        """
-        In the backward pass we receive a Tensor containing the gradient of the loss
-        with respect to the output, and we need to compute the gradient of the loss
-        with respect to the input.
-        """
-        grad_t = grad_x = grad_u = None
-        t, x, u = ctx.saved_tensors
-        x_np = x.t().detach().numpy().astype('float64')
-        u_np = u.t().detach().numpy().astype('float64')
-
-        if ctx.needs_input_grad[0]:
-            raise NotImplementedError("Derivative of RunningCost w.r.t. time not available")
-        if ctx.needs_input_grad[1]:
-            dLdx = torch.tensor([[mpc.getIntermediateCostDerivativeState(t, x_np, u_np)]], device=device, dtype=dtype)
-            grad_x = grad_output * dLdx
-        if ctx.needs_input_grad[2]:
-            dLdu = torch.tensor([[mpc.getIntermediateCostDerivativeInput(t, x_np, u_np)]], device=device, dtype=dtype)
-            grad_u = grad_output * dLdu
-        return grad_t, grad_x, grad_u
-
-
-class StateInputConstraint(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, t, x, u):
-        """
-        In the forward pass we receive a Tensor containing the input and return
-        a Tensor containing the output. ctx is a context object that can be used
-        to stash information for backward computation. You can cache arbitrary
-        objects for use in the backward pass using the ctx.save_for_backward method.
-        """
-        x_cpu = x.cpu()
-        u_cpu = u.cpu()
-        ctx.save_for_backward(t, x_cpu, u_cpu)
-        x_np = x_cpu.t().detach().numpy().astype('float64')
-        u_np = u_cpu.t().detach().numpy().astype('float64')
-        g1 = torch.tensor(mpc.getStateInputConstraint(t, x_np, u_np), device=device, dtype=dtype)
-        return g1
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        """
-        In the backward pass we receive a Tensor containing the gradient of the loss
-        with respect to the output, and we need to compute the gradient of the loss
-        with respect to the input.
-        """
-        grad_t = grad_x = grad_u = None
-        t, x, u = ctx.saved_tensors
-        x_np = x.t().detach().numpy().astype('float64')
-        u_np = u.t().detach().numpy().astype('float64')
-
-        if ctx.needs_input_grad[0]:
-            raise NotImplementedError("Derivative of StateInputConstraint w.r.t. time not available")
-        if ctx.needs_input_grad[1]:
-            raise NotImplementedError("Derivative of StateInputConstraint w.r.t. state not available")
-        if ctx.needs_input_grad[2]:
-            dg1du = torch.tensor(mpc.getStateInputConstraintDerivativeControl(t, x_np, u_np), device=device, dtype=dtype)
-            grad_u = torch.matmul(grad_output, dg1du).reshape((-1, u_np.size))
-        return grad_t, grad_x, grad_u
-
-
-def loss_function(tx, u_pred, dVdx, nu):
-    f = FlowMap.apply(tx[0], tx[1:], u_pred)
-    L = IntermediateCost.apply(tx[0], tx[1:], u_pred)
-    loss = L + dVdx.dot(f)
-    if systemHasConstraints:
-        g1 = StateInputConstraint.apply(tx[0], tx[1:], u_pred)
-        loss += g1.dot(nu)
-    return loss
-
-
-def num_samples_per_trajectory_point(t, max_num_points, half_value_decay_t):
-    """
-    Calculates number of samples drawn for each nominal state point in trajectory
-    :param t: Query time along trajectory
-    :param max_num_points:
-    :param half_value_decay_t: time into trajectory after which number of sampled point is halfed
-    :return: Number of samples to be drawn
-    """
-    return max_num_points * np.exp(-np.log(2) * t / half_value_decay_t)
-
-
-def trajectoryCost(policy, duration, dt_control):
-    cost = 0.0  # running sum
-    numStartingPoints = 1
-    for _ in range(numStartingPoints):
-        startPos = np.zeros([mpc.STATE_DIM, 1])
-        tx = np.concatenate(([[0.0]], startPos))
-        for it in range(int(duration / dt_control)):
-            ttx_torch = torch.tensor(np.concatenate((tx[0, 0], tx[1:]), axis=None), dtype=dtype,
-                                   device=device, requires_grad=False)
-            p, u_pred = policy(ttx_torch)
-            if len(p) > 1:
-                u = torch.matmul(p, u_pred)
-            else:
-                u = u_pred[0]
-
-            u_np = u.t().detach().numpy().astype('float64')
-            cost += torch.tensor(mpc.getIntermediateCost(tx[0], tx[1:], u_np), device=device, dtype=dtype)
-            if np.isnan(cost):
-                return np.nan, tx[0]
-            dx = mpc.computeFlowMap(tx[0], tx[1:], u_np)
-
-            tx[1:] += dx.reshape(mpc.STATE_DIM, 1) * dt_control
-            tx[0, 0] += dt_control
-    return cost, duration
-
-
 writer = SummaryWriter()
+parameter_logger = ParameterLogger(writer, every=1000, min_interval_sec=60.0)
+
+profile_stages = False  # stage timings as profile/* in TensorBoard and in profile.jsonl of the log directory
+if profile_stages:
+    profiling.configure(writer=writer, json_path=os.path.join(writer.logdir, "profile.jsonl"), flush_interval_sec=60.0)
 
 
 load_policy = False
 if load_policy:
     save_path = "/path/to/saved/policy.pt"
-    policy = torch.load(save_path)
+    policy = loadPolicy(save_path)
     policy.eval()
 else:
     policy = PolicyNet(mpc.STATE_DIM+1, mpc.INPUT_DIM)
 
-policy.to(device)
+policy.to(device=device, dtype=dtype)
 
 print("Initial policy parameters:")
 print(list(policy.named_parameters()))
@@ -234,150 +68,215 @@ learning_rate = 1e-2
 optimizer = torch.optim.Adam(policy.parameters(), lr=learning_rate)
 
 
+prioritized_replay = False  # draw samples proportionally to their last loss instead of uniformly
+prioritized_replay_beta0 = 0.4  # importance sampling exponent at the start, annealed to 1 over the training
+memory_class = PrioritizedReplayMemory if prioritized_replay else ReplayMemory
+
+training_state_path = "/tmp/mpcTrainingState"  # complete state for --resume, written periodically and on exit
+training_state_interval_sec = 30.0 * 60.0
+
+start_iteration = 0
 load_memory = False
-if load_memory:
-    with open("/path/to/memory.pkl", 'rb') as memFile:
-        mem = pickle.load(memFile)
+if args.resume is not None:
+    start_iteration, mem = loadTrainingState(args.resume, policy, optimizer, memory_class)
+    print("Resuming training state", args.resume, "at iteration", start_iteration, "with", len(mem), "samples")
+elif load_memory:
+    mem = memory_class.load("/path/to/memory")
 else:
     mem_capacity = 1000000
-    mem = ReplayMemory(mem_capacity)
+    mem_path = None  # set to a directory to keep the samples in memory-mapped files on disk
+    mem = memory_class(mem_capacity, mpc.STATE_DIM, mpc.INPUT_DIM, constraintDim if systemHasConstraints else 0,
+                       dtype=np.float64 if float64_training else np.float32, path=mem_path)
 
 # prepare saving of MPC solution trajectory (always add first point of a slq run)
 mpc_traj_len_sec = 3.0 # length of trajectories to generate with MPC
 dt_control = 1.0/400. # 400 Hz control frequency
-mpc_traj_t = np.linspace(0.0, mpc_traj_len_sec, int(mpc_traj_len_sec/dt_control))
 last_policy_save_time = time.time()
+last_training_state_save_time = time.time()
 
 learning_iterations = 100000
+num_eval_starting_points = 24  # initial states of the rollouts behind metric/oc_cost
+
+evaluator = BackgroundEvaluator(writer.logdir, mpc_traj_len_sec, dt_control, num_eval_starting_points)
+
+collection_options = {
+    "horizon_stride": 10,  # MPC solution points between sampled horizon points, 0 samples only the first point
+    "horizon_half_value_decay_t": 0.25,  # time into the horizon after which half as many samples are drawn
+    "chain_trajectories": False,  # warm start each trajectory from the end of the previous one
+    "chain_length": 5,  # chained trajectories between two resets to a random initial state
+}
+num_collection_workers = 0  # number of background MPC processes, 0 runs the MPC inline in the training loop
+policy_publish_decimation = 100  # iterations between weight updates sent to the collection workers
+if num_collection_workers > 0:
+    collectors = CollectionWorkers(policy, num_collection_workers, mpc_traj_len_sec, dt_control, systemHasConstraints,
+                                   engine_options=collection_options)
+    collectors.start()
+else:
+    collection_engine = CollectionEngine(mpc, targetTrajectories, systemHasConstraints, **collection_options)
+
+# only evaluate the loss of the k highest weighted experts of every sample, None evaluates all. k must be at least 2,
+# the weights of the evaluated experts are renormalized and a single expert would leave the gate without a gradient
+expert_top_k = None
+if expert_top_k is not None and expert_top_k < 2:
+    raise ValueError("expert_top_k must be at least 2 or None, got " + str(expert_top_k))
+expert_weight_threshold = 0.0  # experts weighted below this are not evaluated either, except for the top one
+
+num_training_processes = 1  # processes sharing the loss evaluation of each batch, CPU only
+if num_training_processes > 1:
+    data_parallel = DataParallelLoss(mpc, policy, num_training_processes, constraintDim if systemHasConstraints else 0,
+                                     expert_top_k, expert_weight_threshold)
+
+batch_size = 2**5
+prefetch_batches = 2  # batches sampled ahead in a background thread, 0 samples on the training thread
+if prefetch_batches > 0:
+    prefetcher = BatchPrefetcher(mem, batch_size, device, dtype, prefetch_batches, prioritized_replay)
+
+# preemption sends SIGTERM, which then takes the same path as Ctrl-C and saves the training state
+signal.signal(signal.SIGTERM, signal.default_int_handler)
 
+next_iteration = start_iteration
 print("==============\nStarting training\n==============")
 try:
-    for it in range(learning_iterations):
+    for it in range(start_iteration, learning_iterations):
         alpha_mix = np.clip(1.0 - 1.0 * it / learning_iterations, 0.2, 1.0)
 
-        # run data collection (=MPC) less frequently than the policy updates
-        mpc_decimation = 1 if len(mem) < 15000 else 500
-        if it % mpc_decimation == 0:
-
-            mpc.reset(targetTrajectories)
-            x0 = np.zeros((mpc.STATE_DIM, 1))
-            x0[0] = np.random.uniform(-0.5, 0.5) # base x
-            x0[1] = np.random.uniform(-0.5, 0.5) # base y
-
-
-            print("resetting MPC")
-            print("proportion of MPC policy is", alpha_mix)
-            print("starting from", x0.transpose())
-
-            for mpc_time in mpc_traj_t: # mpc dummy loop
-                mpc.setObservation(mpc_time, x0)
-                try:
-                    mpc.advanceMpc()
-                except RuntimeError:
-                    print("Caught error in MPC advance!!")
-                    break
-                t_result = scalar_array()
-                x_result = state_vector_array()
-                u_result = input_vector_array()
-                mpc.getMpcSolution(t_result, x_result, u_result)
-                K = mpc.getLinearFeedbackGain(t_result[0])
-                # sample around the initial point and push it to the replay buffer
-                for i in range(int(round(num_samples_per_trajectory_point(t_result[0], max_num_points=4, half_value_decay_t=1e10)))):
-                    if i == 0:
-                        x = x_result[0] # definitely push back the nominal point
-                    else:
-                        x = np.random.multivariate_normal(x_result[0], cov=np.diag(0.1 * np.ones(mpc.STATE_DIM)))
-
-                    dVdx = mpc.getValueFunctionStateDerivative(t_result[0], x)
-                    if systemHasConstraints:
-                        nu = mpc.getStateInputConstraintLagrangian(t_result[0], x)
-                    else:
-                        nu = None
-                    mem.push(mpc_time, x, dVdx, None, nu, None, u_result[0] + K.dot(x - x_result[0]))
-
-                # increment state for next time step
-                ttx_torch = torch.tensor(np.concatenate((t_result[0], x_result[0]), axis=None),
-                                         dtype=torch.float, requires_grad=False)
-                p, u_net = policy(ttx_torch)
-                if len(p) > 1:
-                    u_net = torch.matmul(p, u_net)
-                else:
-                    u_net = u_net[0]
-
-                u_mixed = alpha_mix * u_result[0] + (1.0 - alpha_mix) * u_net.detach().numpy().astype('float64')
-                dx = mpc.computeFlowMap(t_result[0], x_result[0], u_mixed)
-                x0 += dt_control * dx.reshape(mpc.STATE_DIM,1)
-
-            print("mpc ended up at", x_result[0])
+        with profiling.stage("collection"):
+            if num_collection_workers > 0:
+                # collection runs in the background, move whatever arrived into the replay memory
+                if it % policy_publish_decimation == 0:
+                    collectors.publish(policy, alpha_mix)
+                collectors.drain(mem)
+                while len(mem) < 15000:
+                    collectors.drain(mem, block=True)
+                if it % 500 == 0:
+                    mem.flush()
+            else:
+                # run data collection (=MPC) less frequently than the policy updates
+                mpc_decimation = 1 if len(mem) < 15000 else 500
+                if it % mpc_decimation == 0:
+                    collection_engine.collectTrajectory(policy, alpha_mix, mem, mpc_traj_len_sec, dt_control)
+                    mem.flush()
 
         # extract batch of samples from replay memory
-        batch_size = 2**5
-        samples = mem.sample(batch_size)
+        with profiling.stage("replay_sample"):
+            if prioritized_replay:
+                mem.beta = prioritized_replay_beta0 + (1.0 - prioritized_replay_beta0) * it / learning_iterations
+                if prefetch_batches > 0:
+                    samples, sample_indices, sample_weights = prefetcher.get()
+                else:
+                    samples, sample_indices, sample_weights = mem.sample_prioritized(batch_size, device, dtype)
+            elif prefetch_batches > 0:
+                samples = prefetcher.get()
+            else:
+                samples = mem.sample(batch_size, device, dtype)
 
         writeLogThisIteration = True
 
         def solver_step_closure():
-            loss = torch.zeros([1], dtype=dtype, device=device)  # running sum over samples
-            mpc_H = torch.zeros([1], dtype=dtype, device=device)  # running sum over samples
-            g1_norm = 0.0  # running sum over samples
-            for sample in samples:
-                tx = torch.tensor(np.concatenate((sample.t, sample.x), axis=None), dtype=dtype, device=device, requires_grad=False)
-                ttx_net = torch.tensor(np.concatenate((sample.t, sample.x), axis=None), dtype=dtype, device=device, requires_grad=False)
-                p, u_pred = policy(ttx_net)
-                dVdx = torch.tensor(sample.dVdx, dtype=dtype, device=device, requires_grad=False)
-                if systemHasConstraints:
-                    nu = torch.tensor(sample.nu, dtype=dtype, device=device, requires_grad=False)
-                else:
-                    nu = None
-                for pi, u_pred_i in zip(p, u_pred): # loop through experts
-                    loss += pi * loss_function(tx, u_pred_i, dVdx, nu)
-                mpc_H += loss_function(tx, torch.tensor(sample.u0), dVdx, nu)
-
-                if len(p) > 1:
-                    u_net = torch.matmul(p, u_pred)
-                else:
-                    u_net = u_pred[0]
+            t, x, dVdx, nu, u0 = samples
+            global writeLogThisIteration
 
-                if systemHasConstraints:
-                    g1_norm += np.linalg.norm(mpc.getStateInputConstraint(sample.t, sample.x, u_net.detach().numpy().astype('float64')))
+            p = expert_mask = None
+            if num_training_processes > 1:
+                with profiling.stage("data_parallel_loss"):
+                    loss, sample_losses, mpc_H = data_parallel.lossAndGradients(
+                        samples, sample_weights if prioritized_replay else None, with_reference=writeLogThisIteration)
+            else:
+                with profiling.stage("policy_forward"):
+                    p, u_pred = policy(torch.cat((t.unsqueeze(1), x), dim=1))
 
-            optimizer.zero_grad()
-            loss.backward()
+                if expert_top_k is not None:
+                    expert_mask = topKExperts(p, expert_top_k, expert_weight_threshold)
 
-            global writeLogThisIteration
-            if writeLogThisIteration:
-                writer.add_scalar('loss/perSample', loss.item() / batch_size, it)
-                writer.add_scalar('loss/constraintViolation', g1_norm / batch_size, it)
-                writeLogThisIteration = False
+                with profiling.stage("loss"):
+                    sample_losses = batch_loss_function(mpc, t, x, p, u_pred, dVdx, nu, expert_mask)
+                if prioritized_replay:
+                    loss = (sample_weights * sample_losses).sum()
+                else:
+                    loss = sample_losses.sum()
+
+                optimizer.zero_grad()
+                with profiling.stage("backward"):
+                    loss.backward()
+
+                if writeLogThisIteration:
+                    with torch.no_grad():
+                        mpc_H = Hamiltonian.apply(mpc, t, x, u0, dVdx, nu)
+
+            if prioritized_replay:
+                mem.update_priorities(sample_indices, toNumpy(sample_losses))
+
+            with profiling.stage("logging"):
+                if writeLogThisIteration:
+                    mpc_H = mpc_H.sum()
+                    g1_norm = 0.0  # running sum over samples
+                    if p is None and (systemHasConstraints or expert_top_k is not None):
+                        with torch.no_grad():
+                            p, u_pred = policy(torch.cat((t.unsqueeze(1), x), dim=1))
+                    if expert_top_k is not None:
+                        if expert_mask is None:
+                            expert_mask = topKExperts(p, expert_top_k, expert_weight_threshold)
+                        writer.add_scalar('gating/evaluatedExpertsPerSample', expert_mask.sum().item() / batch_size, it)
+                        writer.add_scalar('gating/loadImbalance', expertLoadImbalance(expert_mask), it)
+                    if systemHasConstraints:
+                        u_net = toNumpy(torch.matmul(p.unsqueeze(1), u_pred).squeeze(1))
+                        t_np = toNumpy(t)
+                        x_np = toNumpy(x)
+                        for i in range(batch_size):
+                            g1_norm += np.linalg.norm(mpc.getStateInputConstraint(t_np[i], x_np[i], u_net[i]))
+                    writer.add_scalar('loss/perSample', loss.item() / batch_size, it)
+                    writer.add_scalar('loss/mpcHamiltonianPerSample', mpc_H.item() / batch_size, it)
+                    writer.add_scalar('loss/constraintViolation', g1_norm / batch_size, it)
+                    writeLogThisIteration = False
 
             return loss
 
 
-        if it % 200 == 0:
-            oc_cost, survival_time = trajectoryCost(policy=policy, duration=mpc_traj_len_sec, dt_control=dt_control)
-            writer.add_scalar('metric/oc_cost', oc_cost, it)
-            writer.add_scalar('metric/survival_time', survival_time, it)
-            print("iteration", it, "oc_cost", oc_cost)
-
+        # metrics and checkpoints are computed and written by the background evaluator
+        checkpoint_path = None
         if time.time() - last_policy_save_time > 5.0 * 60.0:
             last_policy_save_time = time.time()
             now = datetime.datetime.now()
-            save_path = "/tmp/mpcPolicy_" + now.strftime("%Y-%m-%d_%H%M%S")
-            print("Iteration", it, "saving policy to", save_path + ".pt")
-            torch.save(policy, save_path + ".pt")
+            checkpoint_path = "/tmp/mpcPolicy_" + now.strftime("%Y-%m-%d_%H%M%S") + ".pt"
+        if it % 200 == 0 or checkpoint_path is not None:
+            with profiling.stage("evaluator_submit"):
+                evaluator.submit(it, policy, evaluate=(it % 200 == 0), checkpoint_path=checkpoint_path)
 
 
-        optimizer.step(solver_step_closure)
+        with profiling.stage("optimizer_step"):  # includes the closure
+            optimizer.step(solver_step_closure)
+        with profiling.stage("parameter_logging"):
+            parameter_logger.log(policy, it)
+        profiling.flush(it)
         for param in policy.parameters():
             if(torch.isnan(param).any()):
                 print("nan in policy!")
+        next_iteration = it + 1
+
+        if time.time() - last_training_state_save_time > training_state_interval_sec:
+            with profiling.stage("training_state_save"):
+                saveTrainingState(training_state_path, policy, optimizer, next_iteration, mem)
+            last_training_state_save_time = time.time()
 
 
     print("==============\nTraining completed.\n==============")
 except KeyboardInterrupt:
-    print("==============\nTraining interrupted after iteration", it, ".\n==============")
+    print("==============\nTraining interrupted at iteration", next_iteration, ".\n==============")
     pass
 
+# saved before the helper processes are shut down, which may take long or hang after a preemption
+print("saving training state to", training_state_path)
+saveTrainingState(training_state_path, policy, optimizer, next_iteration, mem)
+profiling.flush(next_iteration, force=True)
+
+if prefetch_batches > 0:
+    prefetcher.close()
+if num_training_processes > 1:
+    data_parallel.close()
+if num_collection_workers > 0:
+    collectors.stop()
+evaluator.close()
+
 
 
 print("optimized policy parameters:")
@@ -386,11 +285,7 @@ print(list(policy.named_parameters()))
 now = datetime.datetime.now()
 save_path = "/tmp/mpcPolicy_" + now.strftime("%Y-%m-%d_%H%M%S")
 print("saving policy to", save_path + ".pt")
-torch.save(policy, save_path + ".pt")
-
-# print("Saving data to", save_path+"_memory.pkl")
-# with open(save_path+"_memory.pkl", 'wb') as outputFile:
-#     pickle.dump(mem, outputFile)
+saveCheckpoint(policySnapshot(policy), save_path + ".pt")
 
 
 writer.close()
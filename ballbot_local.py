@@ -0,0 +1,220 @@
+import numpy as np
+
+
+class _VectorArray(list):
+    """Mimics the resizable std::vector containers exposed by the OCS2 bindings."""
+    fill_value = None
+
+    def resize(self, size):
+        if size < len(self):
+            del self[size:]
+        else:
+            self.extend([self.fill_value] * (size - len(self)))
+
+
+class scalar_array(_VectorArray):
+    fill_value = 0.0
+
+
+class state_vector_array(_VectorArray):
+    pass
+
+
+class input_vector_array(_VectorArray):
+    pass
+
+
+class dynamic_vector_array(_VectorArray):
+    pass
+
+
+class cost_desired_trajectories(object):
+    def __init__(self, desiredTimeTraj, desiredStateTraj, desiredInputTraj):
+        self.desiredTimeTraj = desiredTimeTraj
+        self.desiredStateTraj = desiredStateTraj
+        self.desiredInputTraj = desiredInputTraj
+
+
+def solveCare(A, B, Q, R):
+    """
+    Solves the continuous-time algebraic Riccati equation A'P + PA - PBR^-1B'P + Q = 0
+    from the stable invariant subspace of the associated Hamiltonian matrix.
+    """
+    n = A.shape[0]
+    R_inv = np.linalg.inv(R)
+    H = np.block([[A, -B.dot(R_inv).dot(B.T)],
+                  [-Q, -A.T]])
+    eigVals, eigVecs = np.linalg.eig(H)
+    stable = eigVecs[:, eigVals.real < 0.0]
+    if stable.shape[1] != n:
+        raise RuntimeError("Riccati equation has no stabilizing solution")
+    P = np.real(stable[n:].dot(np.linalg.inv(stable[:n])))
+    return 0.5 * (P + P.T)
+
+
+class mpc_interface(object):
+    """
+    Pure NumPy stand-in for the OCS2 ballbot python bindings.
+
+    The ballbot is modelled as two decoupled inverted pendulums on a planar ball, one per horizontal axis,
+    plus a yaw double integrator. The state is (px, py, thetaz, thetay, thetax) followed by their velocities,
+    the input consists of the ball torques in x and y and the yaw torque. The cost is quadratic around the
+    target, and the "MPC" is an LQR designed at the target whose closed-loop rollout over the horizon is
+    returned as the MPC solution. Only the methods used by the learner and the evaluation are provided.
+    """
+
+    STATE_DIM = 10
+    INPUT_DIM = 3
+
+    gravity_over_length = 9.81 / 0.5
+    inv_length = 1.0 / 0.5
+    ball_input_gain = 2.0
+    yaw_input_gain = 5.0
+
+    Q = np.diag([10.0, 10.0, 1.0, 20.0, 20.0, 1.0, 1.0, 0.5, 2.0, 2.0])
+    R = np.diag([0.5, 0.5, 0.5])
+
+    def __init__(self, taskFileFolder="mpc", asynchronous=False, horizon=1.0, dt=0.01):
+        self.horizon = horizon
+        self.dt = dt
+        self.x_ref = np.zeros(self.STATE_DIM)
+        self.u_ref = np.zeros(self.INPUT_DIM)
+        self._updateLqr()
+        self.t_obs = 0.0
+        self.x_obs = np.zeros(self.STATE_DIM)
+        self.t_traj = self.x_traj = self.u_traj = None
+        self._derivativePoint = None
+
+    def _updateLqr(self):
+        A = self._flowMapDerivativeState(self.x_ref[np.newaxis], self.u_ref[np.newaxis])[0]
+        B = self._flowMapDerivativeInput(self.x_ref[np.newaxis])[0]
+        self.P = solveCare(A, B, self.Q, self.R)
+        self.K = -np.linalg.solve(self.R, B.T.dot(self.P))
+
+    # dynamics on batches of states X (N, STATE_DIM) and inputs U (N, INPUT_DIM)
+
+    def _flowMap(self, X, U):
+        thy, thx = X[:, 3], X[:, 4]
+        ddpx = self.ball_input_gain * U[:, 0]
+        ddpy = self.ball_input_gain * U[:, 1]
+        xDot = np.empty_like(X)
+        xDot[:, :5] = X[:, 5:]
+        xDot[:, 5] = ddpx
+        xDot[:, 6] = ddpy
+        xDot[:, 7] = self.yaw_input_gain * U[:, 2]
+        xDot[:, 8] = self.gravity_over_length * np.sin(thy) - self.inv_length * np.cos(thy) * ddpx
+        xDot[:, 9] = self.gravity_over_length * np.sin(thx) + self.inv_length * np.cos(thx) * ddpy
+        return xDot
+
+    def _flowMapDerivativeState(self, X, U):
+        thy, thx = X[:, 3], X[:, 4]
+        ddpx = self.ball_input_gain * U[:, 0]
+        ddpy = self.ball_input_gain * U[:, 1]
+        dfdx = np.zeros((len(X), self.STATE_DIM, self.STATE_DIM))
+        dfdx[:, range(5), range(5, 10)] = 1.0
+        dfdx[:, 8, 3] = self.gravity_over_length * np.cos(thy) + self.inv_length * np.sin(thy) * ddpx
+        dfdx[:, 9, 4] = self.gravity_over_length * np.cos(thx) - self.inv_length * np.sin(thx) * ddpy
+        return dfdx
+
+    def _flowMapDerivativeInput(self, X):
+        thy, thx = X[:, 3], X[:, 4]
+        dfdu = np.zeros((len(X), self.STATE_DIM, self.INPUT_DIM))
+        dfdu[:, 5, 0] = self.ball_input_gain
+        dfdu[:, 6, 1] = self.ball_input_gain
+        dfdu[:, 7, 2] = self.yaw_input_gain
+        dfdu[:, 8, 0] = -self.inv_length * np.cos(thy) * self.ball_input_gain
+        dfdu[:, 9, 1] = self.inv_length * np.cos(thx) * self.ball_input_gain
+        return dfdu
+
+    def _intermediateCost(self, X, U):
+        dx = X - self.x_ref
+        du = U - self.u_ref
+        return 0.5 * np.einsum('ni,ij,nj->n', dx, self.Q, dx) + 0.5 * np.einsum('ni,ij,nj->n', du, self.R, du)
+
+    # single point interface of the bindings
+
+    def _point(self, x, u=None):
+        x = np.asarray(x, dtype=np.float64).reshape((1, self.STATE_DIM))
+        if u is None:
+            return x
+        return x, np.asarray(u, dtype=np.float64).reshape((1, self.INPUT_DIM))
+
+    def computeFlowMap(self, t, x, u):
+        return self._flowMap(*self._point(x, u))[0]
+
+    def computeFlowMapBatch(self, t, x, u):
+        """Flow map at N points, x (N, STATE_DIM) and u (N, INPUT_DIM), not part of the OCS2 bindings."""
+        return self._flowMap(np.asarray(x, dtype=np.float64), np.asarray(u, dtype=np.float64))
+
+    def setFlowMapDerivativeStateAndControl(self, t, x, u):
+        self._derivativePoint = self._point(x, u)
+
+    def computeFlowMapDerivativeState(self):
+        return self._flowMapDerivativeState(*self._derivativePoint)[0]
+
+    def computeFlowMapDerivativeInput(self):
+        return self._flowMapDerivativeInput(self._derivativePoint[0])[0]
+
+    def getIntermediateCost(self, t, x, u):
+        return float(self._intermediateCost(*self._point(x, u))[0])
+
+    def getIntermediateCostBatch(self, t, x, u):
+        """Running cost at N points, not part of the OCS2 bindings."""
+        return self._intermediateCost(np.asarray(x, dtype=np.float64), np.asarray(u, dtype=np.float64))
+
+    def getIntermediateCostDerivativeState(self, t, x, u):
+        x, _ = self._point(x, u)
+        return self.Q.dot(x[0] - self.x_ref)
+
+    def getIntermediateCostDerivativeInput(self, t, x, u):
+        _, u = self._point(x, u)
+        return self.R.dot(u[0] - self.u_ref)
+
+    def getStateInputConstraint(self, t, x, u):
+        return np.zeros(0)
+
+    def getStateInputConstraintDerivativeControl(self, t, x, u):
+        return np.zeros((0, self.INPUT_DIM))
+
+    def getStateInputConstraintLagrangian(self, t, x):
+        return np.zeros(0)
+
+    def getValueFunctionStateDerivative(self, t, x):
+        return self.P.dot(self._point(x)[0] - self.x_ref)
+
+    # MPC interface, solved by the LQR around the target
+
+    def reset(self, targetTrajectories):
+        self.x_ref = np.asarray(targetTrajectories.desiredStateTraj[0], dtype=np.float64).reshape(self.STATE_DIM)
+        self.u_ref = np.asarray(targetTrajectories.desiredInputTraj[0], dtype=np.float64).reshape(self.INPUT_DIM)
+        self._updateLqr()
+        self.t_traj = self.x_traj = self.u_traj = None
+
+    def setObservation(self, t, x):
+        self.t_obs = float(t)
+        self.x_obs = self._point(x)[0].copy()
+
+    def advanceMpc(self):
+        num_steps = int(round(self.horizon / self.dt))
+        self.t_traj = self.t_obs + self.dt * np.arange(num_steps + 1)
+        self.x_traj = np.empty((num_steps + 1, self.STATE_DIM))
+        self.u_traj = np.empty((num_steps + 1, self.INPUT_DIM))
+        x = self.x_obs.copy()
+        for k in range(num_steps + 1):
+            u = self.u_ref + self.K.dot(x - self.x_ref)
+            self.x_traj[k] = x
+            self.u_traj[k] = u
+            x = x + self.dt * self._flowMap(x[np.newaxis], u[np.newaxis])[0]
+        if not np.all(np.isfinite(self.x_traj)):
+            raise RuntimeError("LQR rollout diverged")
+
+    def getMpcSolution(self, t_result, x_result, u_result):
+        t_result.resize(0)
+        x_result.resize(0)
+        u_result.resize(0)
+        t_result.extend(self.t_traj)
+        x_result.extend(self.x_traj)
+        u_result.extend(self.u_traj)
+
+    def getLinearFeedbackGain(self, t):
+        return self.K.copy()
@@ -0,0 +1,135 @@
+"""
+Torch autograd wrapper around the Hamiltonian of an mpc_interface and the losses built from it.
+The mpc_interface is passed as the first argument.
+"""
+import numpy as np
+import torch
+
+import profiling
+
+
+def toNumpy(tensor):
+    """float64 numpy array of a tensor, which shares its memory if it is a contiguous float64 CPU tensor."""
+    return np.ascontiguousarray(tensor.detach().cpu().numpy(), dtype=np.float64)
+
+
+def fromNumpy(array, like):
+    """Tensor with the device and dtype of like, which shares memory with array for float64 CPU tensors."""
+    return torch.from_numpy(array).to(device=like.device, dtype=like.dtype)
+
+
+class Hamiltonian(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, mpc, t, x, u, dVdx, nu):
+        """
+        Evaluates H = L + dVdx*f (+ nu*g1) for a whole batch of N points as a single autograd node.
+        t is (N,), x and dVdx are (N, STATE_DIM), u is (N, INPUT_DIM) and nu is (N, NUM_CONSTRAINTS) or None.
+        If a gradient w.r.t. u is required, dH/du is computed in the same sweep over the bindings
+        so that the backward pass needs no further calls into the solver.
+        """
+        t_np = toNumpy(t)
+        x_np = toNumpy(x)
+        u_np = toNumpy(u)
+        dVdx_np = toNumpy(dVdx)
+        nu_np = toNumpy(nu) if nu is not None else None
+        needs_grad_u = ctx.needs_input_grad[3]
+
+        # the binding results are written row by row into these buffers, which the returned tensors then share
+        H = np.empty(len(t_np))
+        dHdu = np.empty(u_np.shape) if needs_grad_u else None
+        with profiling.stage("dynamics_bindings"):
+            for i in range(len(t_np)):
+                t_i, x_i, u_i = t_np[i], x_np[i], u_np[i]
+                f = np.asarray(mpc.computeFlowMap(t_i, x_i, u_i)).reshape(-1)
+                H[i] = mpc.getIntermediateCost(t_i, x_i, u_i) + dVdx_np[i].dot(f)
+                if nu_np is not None:
+                    H[i] += nu_np[i].dot(np.asarray(mpc.getStateInputConstraint(t_i, x_i, u_i)).reshape(-1))
+                if needs_grad_u:
+                    mpc.setFlowMapDerivativeStateAndControl(t_i, x_i, u_i)
+                    dfdu = np.asarray(mpc.computeFlowMapDerivativeInput())
+                    dLdu = np.asarray(mpc.getIntermediateCostDerivativeInput(t_i, x_i, u_i)).reshape(-1)
+                    dHdu[i] = dLdu + dVdx_np[i].dot(dfdu)
+                    if nu_np is not None:
+                        dHdu[i] += nu_np[i].dot(np.asarray(mpc.getStateInputConstraintDerivativeControl(t_i, x_i, u_i)))
+        profiling.count("hamiltonian_points", len(t_np))
+
+        if needs_grad_u:
+            ctx.save_for_backward(fromNumpy(dHdu, u))
+        return fromNumpy(H, u)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        """
+        The input derivative was already evaluated in the forward pass, only the chain rule remains.
+        """
+        grad_u = None
+        if ctx.needs_input_grad[1]:
+            raise NotImplementedError("Derivative of Hamiltonian w.r.t. time not available")
+        if ctx.needs_input_grad[2]:
+            raise NotImplementedError("Derivative of Hamiltonian w.r.t. state not available")
+        if ctx.needs_input_grad[3]:
+            dHdu, = ctx.saved_tensors
+            grad_u = grad_output.unsqueeze(1) * dHdu
+        return None, None, None, grad_u, None, None
+
+
+def topKExperts(p, k, threshold=0.0):
+    """
+    Selects the experts whose Hamiltonian enters the loss: the k experts of highest weight of every sample,
+    without those weighted below threshold. The expert of highest weight is always selected.
+    k must be at least 2: the selected weights are renormalized, which leaves a single expert a constant weight of one
+    and the gate without a gradient.
+    :param p: Expert weights (B, num_experts)
+    :return: Boolean mask (B, num_experts)
+    """
+    if k < 2:
+        raise ValueError("k must be at least 2, a single expert gives the gate no gradient, got " + str(k))
+    with torch.no_grad():
+        top = p.topk(min(k, p.shape[1]), dim=1).indices
+        mask = torch.zeros(p.shape, dtype=torch.bool, device=p.device)
+        mask.scatter_(1, top, True)
+        mask &= p >= threshold
+        mask.scatter_(1, top[:, :1], True)
+    return mask
+
+
+def expertLoadImbalance(expert_mask):
+    """
+    Coefficient of variation of the number of samples each expert was selected for, 0 for a balanced load.
+    :param expert_mask: Boolean mask (B, num_experts) as returned by topKExperts
+    """
+    load = expert_mask.sum(dim=0).to(torch.float64)
+    return (load.std(unbiased=False) / load.mean()).item()
+
+
+def batch_loss_function(mpc, t, x, p, u_pred, dVdx, nu, expert_mask=None):
+    """
+    Gating-weighted Hamiltonian loss for a batch of B samples and all of their experts
+    :param mpc: mpc_interface evaluating the dynamics and cost
+    :param t: Sample times (B,)
+    :param x: Sample states (B, STATE_DIM)
+    :param p: Expert weights (B, num_experts)
+    :param u_pred: Expert inputs (B, num_experts, INPUT_DIM)
+    :param dVdx: Value function state derivatives (B, STATE_DIM)
+    :param nu: Constraint Lagrange multipliers (B, NUM_CONSTRAINTS) or None
+    :param expert_mask: Optional boolean mask (B, num_experts) of the experts to evaluate, e.g. from topKExperts.
+                        The weights of the selected experts are renormalized to sum to one in every sample,
+                        so that the loss stays a mixture and the gate cannot lower it by moving weight onto
+                        experts that are not evaluated. A sample with a single selected expert,
+                        e.g. because all others are below the threshold of topKExperts, gives the gate no gradient.
+    :return: Per-sample loss (B,)
+    """
+    B, num_experts = p.shape
+    if expert_mask is None:
+        H = Hamiltonian.apply(mpc, t.repeat_interleave(num_experts),
+                              x.repeat_interleave(num_experts, dim=0),
+                              u_pred.reshape((B * num_experts, -1)),
+                              dVdx.repeat_interleave(num_experts, dim=0),
+                              nu.repeat_interleave(num_experts, dim=0) if nu is not None else None)
+        return (p * H.reshape((B, num_experts))).sum(dim=1)
+    rows, experts = expert_mask.nonzero(as_tuple=True)
+    H = Hamiltonian.apply(mpc, t[rows], x[rows], u_pred[rows, experts], dVdx[rows],
+                          nu[rows] if nu is not None else None)
+    p_selected = p[rows, experts]
+    p_selected = p_selected / torch.zeros(B, dtype=p.dtype, device=p.device).index_add(0, rows, p_selected)[rows]
+    return torch.zeros(B, dtype=H.dtype, device=H.device).index_add(0, rows, p_selected * H)
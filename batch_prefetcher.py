@@ -0,0 +1,73 @@
+import queue
+import threading
+import torch
+
+
+class BatchPrefetcher(object):
+    """
+    Draws the next num_batches training batches from a replay memory in a background thread, so that sampling
+    and stacking overlap with the optimizer step instead of preceding it.
+    Batches are prepared on the CPU, in pinned memory if they are bound for a GPU, and moved to the device in get().
+    With prioritized sampling, prefetched batches were drawn with the priorities known when they were prepared.
+    """
+
+    def __init__(self, mem, batch_size, device=torch.device("cpu"), dtype=None, num_batches=2, prioritized=False):
+        self.mem = mem
+        self.batch_size = batch_size
+        self.device = device
+        self.dtype = dtype
+        self.prioritized = prioritized
+        self.pin_memory = device.type == "cuda"
+        self.batch_queue = queue.Queue(maxsize=num_batches)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _prepare(self):
+        if self.prioritized:
+            samples, indices, weights = self.mem.sample_prioritized(self.batch_size, dtype=self.dtype)
+        else:
+            samples, indices, weights = self.mem.sample(self.batch_size, dtype=self.dtype), None, None
+        if self.pin_memory:
+            samples = samples._make(None if column is None else column.pin_memory() for column in samples)
+            weights = weights.pin_memory() if weights is not None else None
+        return samples, indices, weights
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = self._prepare()
+            except Exception as error:
+                self.batch_queue.put(error)  # raised on the training thread by get()
+                return
+            while not self.stop_event.is_set():
+                try:
+                    self.batch_queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """
+        Returns the next batch, starting the background thread on the first call.
+        :return: Sample of stacked tensors on the device, or (Sample, indices, weights) if prioritized
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        batch = self.batch_queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        samples, indices, weights = batch
+        if self.device.type != "cpu":
+            samples = samples._make(None if column is None else column.to(self.device, non_blocking=self.pin_memory)
+                                    for column in samples)
+            weights = weights.to(self.device, non_blocking=self.pin_memory) if weights is not None else None
+        if self.prioritized:
+            return samples, indices, weights
+        return samples
+
+    def close(self):
+        """Stops the background thread, batches that were not fetched yet are discarded."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,267 @@
+"""
+Benchmarks of the training, data collection, rollout, control step and replay memory hot paths.
+
+Runs against the NumPy ballbot stand-in unless MPCNET_BACKEND is set explicitly and writes one JSON record
+per measurement, so that results of different versions can be compared, e.g.
+    python3 benchmark.py --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault("MPCNET_BACKEND", "local")
+
+import numpy as np
+import torch
+
+import PolicyNet
+from ballbot_backend import backend, mpc_interface
+from ballbot_evaluation import trajectoryCost
+from ballbot_losses import batch_loss_function
+from mpc_collection import getTargetTrajectories, CollectionEngine
+from PolicyNet import POLICY_CLASSES
+from replay_memory import ReplayMemory, PrioritizedReplayMemory
+
+
+def _procStatusMb(field):
+    with open("/proc/self/status") as statusFile:
+        for line in statusFile:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024.0
+
+
+class RssMeter(object):
+    """
+    Resident memory of a single measurement. ru_maxrss is the peak over the lifetime of the process and would
+    carry the peak of earlier measurements over, so the resettable high-water mark of Linux is used instead.
+    """
+
+    def __init__(self):
+        with open("/proc/self/clear_refs", 'w') as clearRefs:
+            clearRefs.write("5")
+        self.start_mb = _procStatusMb("VmRSS")
+
+    def result(self):
+        """Peak resident memory since construction and its increase over the resident memory at construction."""
+        peak_mb = _procStatusMb("VmHWM")
+        return {"peak_rss_mb": peak_mb, "rss_increase_mb": peak_mb - self.start_mb}
+
+
+def timeIt(fn, min_time, min_calls=1):
+    """Calls fn repeatedly for at least min_time seconds and returns (number of calls, elapsed seconds)."""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time and calls >= min_calls:
+            return calls, elapsed
+
+
+def randomMemory(mpc, capacity, num_samples, dtype=np.float32):
+    mem = ReplayMemory(capacity, mpc.STATE_DIM, mpc.INPUT_DIM, dtype=dtype)
+    x = np.random.normal(scale=0.2, size=(num_samples, mpc.STATE_DIM))
+    dVdx = np.stack([mpc.getValueFunctionStateDerivative(0.0, x_i) for x_i in x[:min(num_samples, 1000)]])
+    dVdx = np.resize(dVdx, x.shape)
+    mem.push_batch(np.random.uniform(0.0, 3.0, num_samples), x, dVdx, None,
+                   np.random.normal(size=(num_samples, mpc.INPUT_DIM)))
+    return mem
+
+
+def benchBindings(mpc, args):
+    x = np.random.normal(scale=0.2, size=mpc.STATE_DIM)
+    u = np.random.normal(size=mpc.INPUT_DIM)
+
+    def flowMapDerivatives():
+        mpc.setFlowMapDerivativeStateAndControl(0.0, x, u)
+        mpc.computeFlowMapDerivativeState()
+        mpc.computeFlowMapDerivativeInput()
+
+    calls = {
+        "computeFlowMap": lambda: mpc.computeFlowMap(0.0, x, u),
+        "flowMapDerivatives": flowMapDerivatives,
+        "getIntermediateCost": lambda: mpc.getIntermediateCost(0.0, x, u),
+        "getIntermediateCostDerivativeInput": lambda: mpc.getIntermediateCostDerivativeInput(0.0, x, u),
+        "getValueFunctionStateDerivative": lambda: mpc.getValueFunctionStateDerivative(0.0, x),
+    }
+    for name, fn in calls.items():
+        num_calls, elapsed = timeIt(fn, args.min_time)
+        yield {"component": "binding", "call": name, "us_per_call": 1e6 * elapsed / num_calls}
+
+
+def benchOptimizerStep(mpc, args):
+    for dtype_name in args.dtypes:
+        mem = randomMemory(mpc, args.train_buffer_size, args.train_buffer_size, dtype=np.dtype(dtype_name))
+        for policy_name, batch_size in itertools.product(args.policies, args.batch_sizes):
+            rss = RssMeter()
+            policy = getattr(PolicyNet, policy_name)(mpc.STATE_DIM + 1, mpc.INPUT_DIM).to(getattr(torch, dtype_name))
+            optimizer = torch.optim.Adam(policy.parameters(), lr=1e-3)
+
+            def step():
+                t, x, dVdx, nu, u0 = mem.sample(batch_size)
+
+                def closure():
+                    p, u_pred = policy(torch.cat((t.unsqueeze(1), x), dim=1))
+                    loss = batch_loss_function(mpc, t, x, p, u_pred, dVdx, nu).sum()
+                    optimizer.zero_grad()
+                    loss.backward()
+                    return loss
+
+                optimizer.step(closure)
+
+            num_steps, elapsed = timeIt(step, args.min_time, min_calls=3)
+            yield {"component": "optimizer_step", "policy": policy_name, "batch_size": batch_size, "dtype": dtype_name,
+                   "steps_per_sec": num_steps / elapsed, "samples_per_sec": num_steps * batch_size / elapsed,
+                   **rss.result()}
+
+
+def benchCollection(mpc, args):
+    targetTrajectories = getTargetTrajectories(mpc)
+    policy = PolicyNet.ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM)
+    dt_control = 1.0 / 400.0
+    modes = {
+        "first_point": {},
+        "horizon_chained": {"horizon_stride": 10, "horizon_half_value_decay_t": 0.25, "chain_trajectories": True},
+    }
+    for mode, engine_options in modes.items():
+        mem = None  # release the samples of the previous mode
+        rss = RssMeter()
+        engine = CollectionEngine(mpc, targetTrajectories, **engine_options)
+        mem = ReplayMemory(10 ** 6, mpc.STATE_DIM, mpc.INPUT_DIM)
+
+        def trajectory():
+            with contextlib.redirect_stdout(io.StringIO()):
+                engine.collectTrajectory(policy, 0.5, mem, args.collection_traj_len, dt_control)
+
+        num_traj, elapsed = timeIt(trajectory, args.min_time)
+        mpc_steps = num_traj * int(args.collection_traj_len / dt_control)
+        yield {"component": "collection", "mode": mode, "trajectory_length": args.collection_traj_len,
+               "samples_per_sec": len(mem) / elapsed, "mpc_steps_per_sec": mpc_steps / elapsed,
+               **rss.result()}
+
+
+def benchRollout(mpc, args):
+    dt_control = 1.0 / 400.0
+    for policy_name in args.policies:
+        policy = getattr(PolicyNet, policy_name)(mpc.STATE_DIM + 1, mpc.INPUT_DIM)
+        for num_starts in args.rollout_starts:
+            rss = RssMeter()
+            num_rollouts, elapsed = timeIt(lambda: trajectoryCost(mpc, policy, args.rollout_duration, dt_control,
+                                                                  numStartingPoints=num_starts),
+                                           args.min_time)
+            rollout_steps = num_rollouts * num_starts * int(args.rollout_duration / dt_control)
+            yield {"component": "rollout", "policy": policy_name, "starting_points": num_starts,
+                   "rollout_steps_per_sec": rollout_steps / elapsed, **rss.result()}
+
+
+def benchControlStep(mpc, args):
+    """Per-step latency of the policy inside the 400 Hz control loop, eager torch versus frozen weights."""
+    tx = np.random.normal(scale=0.2, size=mpc.STATE_DIM + 1)
+    for policy_name in args.policies:
+        policy = getattr(PolicyNet, policy_name)(mpc.STATE_DIM + 1, mpc.INPUT_DIM)
+        frozen_policy = policy.freeze()
+
+        def eager():
+            with torch.no_grad():
+                return policy.action(torch.tensor(tx, dtype=torch.float)).numpy().astype('float64')
+
+        def frozen():
+            frozen_policy.input[:] = tx
+            return frozen_policy.evaluate()
+
+        for mode, fn in (("eager", eager), ("frozen", frozen)):
+            latencies = []
+            start = time.perf_counter()
+            while time.perf_counter() - start < args.min_time or len(latencies) < 100:
+                step_start = time.perf_counter()
+                fn()
+                latencies.append(time.perf_counter() - step_start)
+            p50, p99 = 1e6 * np.percentile(latencies, [50, 99])
+            yield {"component": "control_step", "policy": policy_name, "mode": mode,
+                   "p50_us": p50, "p99_us": p99, "steps": len(latencies)}
+
+
+def benchReplaySample(mpc, args):
+    for buffer_size in args.buffer_sizes:
+        # release the buffer of the previous size first so that the peak includes only this buffer
+        mem = None
+        rss = RssMeter()
+        mem = PrioritizedReplayMemory(buffer_size, mpc.STATE_DIM, mpc.INPUT_DIM)
+        mem.push_batch(np.zeros(buffer_size), np.zeros((buffer_size, mpc.STATE_DIM)),
+                       np.zeros((buffer_size, mpc.STATE_DIM)), None, np.zeros((buffer_size, mpc.INPUT_DIM)))
+        mem.update_priorities(np.arange(buffer_size), np.random.exponential(size=buffer_size))
+        for batch_size in args.batch_sizes:
+            losses = np.random.exponential(size=batch_size)
+
+            def prioritized():
+                _, indices, _ = mem.sample_prioritized(batch_size)
+                mem.update_priorities(indices, losses)
+
+            for mode, fn in (("uniform", lambda: mem.sample(batch_size)), ("prioritized", prioritized)):
+                num_calls, elapsed = timeIt(fn, args.min_time)
+                yield {"component": "replay_sample", "mode": mode, "buffer_size": buffer_size,
+                       "batch_size": batch_size, "samples_per_sec": num_calls * batch_size / elapsed,
+                       "us_per_call": 1e6 * elapsed / num_calls, **rss.result()}
+
+
+BENCHMARKS = {
+    "binding": benchBindings,
+    "optimizer_step": benchOptimizerStep,
+    "collection": benchCollection,
+    "rollout": benchRollout,
+    "control_step": benchControlStep,
+    "replay_sample": benchReplaySample,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--components", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--policies", nargs="+", default=list(POLICY_CLASSES), choices=POLICY_CLASSES)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32, 128])
+    parser.add_argument("--dtypes", nargs="+", default=["float32", "float64"], choices=["float32", "float64"],
+                        help="precisions of the optimizer step benchmark")
+    parser.add_argument("--buffer-sizes", nargs="+", type=int, default=[10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument("--train-buffer-size", type=int, default=10 ** 4)
+    parser.add_argument("--collection-traj-len", type=float, default=0.5, help="seconds of MPC per trajectory")
+    parser.add_argument("--rollout-duration", type=float, default=1.0, help="seconds per evaluation rollout")
+    parser.add_argument("--rollout-starts", nargs="+", type=int, default=[1, 24],
+                        help="numbers of initial states evaluated in lockstep")
+    parser.add_argument("--min-time", type=float, default=1.0, help="minimum seconds spent per measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    mpc = mpc_interface("mpc", False)
+    mpc.reset(getTargetTrajectories(mpc))
+
+    results = []
+    for component in args.components:
+        for result in BENCHMARKS[component](mpc, args):
+            print(json.dumps(result), file=sys.stderr, flush=True)
+            results.append(result)
+
+    report = {
+        "meta": {"backend": backend, "python": platform.python_version(), "torch": torch.__version__,
+                 "numpy": np.__version__, "machine": platform.machine(), "num_threads": torch.get_num_threads(),
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
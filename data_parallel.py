@@ -0,0 +1,158 @@
+import socket
+import torch
+import torch.distributed as dist
+
+from ballbot_losses import Hamiltonian, batch_loss_function, topKExperts
+from mpc_collection import initWorkerProcess, workerContext
+
+_STOP = 0
+_STEP = 1
+
+
+def _freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _shard(batch_size, rank, world_size):
+    """Contiguous range of the batch rows evaluated by rank."""
+    bounds = [batch_size * r // world_size for r in range(world_size + 1)]
+    return slice(bounds[rank], bounds[rank + 1])
+
+
+def _flatGradient(policy):
+    return torch.cat([(param.grad if param.grad is not None else torch.zeros_like(param)).reshape(-1)
+                      for param in policy.parameters()])
+
+
+def _shardLossAndGradients(mpc, policy, batch, state_dim, constraint_dim, expert_top_k, expert_weight_threshold,
+                           rank, world_size, with_weights, with_reference):
+    """
+    Evaluates the loss of this rank's part of a packed batch and leaves its gradient in the policy.
+    :return: Tensor (2, B) holding the per-sample losses and reference Hamiltonians of the shard, zero elsewhere
+    """
+    t = batch[:, 0]
+    x = batch[:, 1:1 + state_dim]
+    dVdx = batch[:, 1 + state_dim:1 + 2 * state_dim]
+    nu = batch[:, 1 + 2 * state_dim:1 + 2 * state_dim + constraint_dim] if constraint_dim > 0 else None
+    u0 = batch[:, 1 + 2 * state_dim + constraint_dim:batch.shape[1] - with_weights]
+    weights = batch[:, -1] if with_weights else None
+
+    rows = _shard(len(batch), rank, world_size)
+    sample_stats = torch.zeros((2, len(batch)), dtype=batch.dtype)
+    policy.zero_grad()
+    if rows.start == rows.stop:
+        return sample_stats
+    p, u_pred = policy(torch.cat((t[rows].unsqueeze(1), x[rows]), dim=1))
+    nu_rows = nu[rows] if nu is not None else None
+    expert_mask = topKExperts(p, expert_top_k, expert_weight_threshold) if expert_top_k is not None else None
+    sample_losses = batch_loss_function(mpc, t[rows], x[rows], p, u_pred, dVdx[rows], nu_rows, expert_mask)
+    loss = (weights[rows] * sample_losses).sum() if with_weights else sample_losses.sum()
+    loss.backward()
+    sample_stats[0, rows] = sample_losses.detach()
+    if with_reference:
+        with torch.no_grad():
+            sample_stats[1, rows] = Hamiltonian.apply(mpc, t[rows], x[rows], u0[rows], dVdx[rows], nu_rows)
+    return sample_stats
+
+
+def _trainingWorker(rank, world_size, port, policy, state_dim, constraint_dim, expert_top_k, expert_weight_threshold):
+    mpc = initWorkerProcess()
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:{}".format(port), rank=rank, world_size=world_size)
+    dtype = next(policy.parameters()).dtype
+    parameters = torch.nn.utils.parameters_to_vector(policy.parameters()).detach()
+    while True:
+        header = torch.zeros(5, dtype=torch.int64)
+        dist.broadcast(header, src=0)
+        command, batch_size, num_columns, with_weights, with_reference = header.tolist()
+        if command == _STOP:
+            break
+        batch = torch.empty((batch_size, num_columns), dtype=dtype)
+        dist.broadcast(parameters, src=0)
+        dist.broadcast(batch, src=0)
+        torch.nn.utils.vector_to_parameters(parameters, policy.parameters())
+        sample_stats = _shardLossAndGradients(mpc, policy, batch, state_dim, constraint_dim, expert_top_k,
+                                              expert_weight_threshold, rank, world_size, bool(with_weights),
+                                              bool(with_reference))
+        dist.all_reduce(_flatGradient(policy))
+        dist.all_reduce(sample_stats)
+    dist.destroy_process_group()
+
+
+class DataParallelLoss(object):
+    """
+    Evaluates the batch loss of the learner in num_processes processes on localhost, each with its own
+    mpc_interface. The calling process is rank 0: it sends the current weights and the batch to the other
+    ranks, every rank computes the loss and gradient of a contiguous shard of the batch, and the gradients
+    and per-sample losses are summed with torch.distributed (gloo) into the policy of rank 0.
+    CPU only, the optimizer keeps running in the calling process.
+    """
+
+    def __init__(self, mpc, policy, num_processes, constraint_dim=0, expert_top_k=None, expert_weight_threshold=0.0):
+        """:param expert_top_k: Evaluate only the loss of the selected experts, see topKExperts"""
+        self.mpc = mpc
+        self.policy = policy
+        self.world_size = num_processes
+        self.state_dim = mpc.STATE_DIM
+        self.constraint_dim = constraint_dim
+        self.expert_top_k = expert_top_k
+        self.expert_weight_threshold = expert_weight_threshold
+        self.in_collective = False
+        port = _freePort()
+        ctx = workerContext()
+        self.processes = [ctx.Process(target=_trainingWorker,
+                                      args=(rank, num_processes, port, policy, self.state_dim, constraint_dim,
+                                            expert_top_k, expert_weight_threshold),
+                                      daemon=True)
+                          for rank in range(1, num_processes)]
+        for process in self.processes:
+            process.start()
+        dist.init_process_group("gloo", init_method="tcp://127.0.0.1:{}".format(port), rank=0, world_size=num_processes)
+
+    def lossAndGradients(self, samples, weights=None, with_reference=False):
+        """
+        Sets the gradient of the policy to that of the (weighted) summed loss over the batch.
+        :param samples: Sample of stacked tensors
+        :param weights: Optional per-sample weights of the loss (B,)
+        :param with_reference: Also evaluate the Hamiltonian of the MPC inputs u0
+        :return: (summed loss, per-sample losses (B,), per-sample Hamiltonians of u0 (B,) or None), all detached
+        """
+        t, x, dVdx, nu, u0 = samples
+        columns = [t.unsqueeze(1), x, dVdx] + ([nu] if nu is not None else []) + [u0]
+        if weights is not None:
+            columns.append(weights.unsqueeze(1))
+        batch = torch.cat(columns, dim=1).contiguous()
+        header = torch.tensor([_STEP, batch.shape[0], batch.shape[1], weights is not None, with_reference],
+                              dtype=torch.int64)
+
+        self.in_collective = True
+        dist.broadcast(header, src=0)
+        dist.broadcast(torch.nn.utils.parameters_to_vector(self.policy.parameters()).detach(), src=0)
+        dist.broadcast(batch, src=0)
+        sample_stats = _shardLossAndGradients(self.mpc, self.policy, batch, self.state_dim, self.constraint_dim,
+                                              self.expert_top_k, self.expert_weight_threshold, 0, self.world_size,
+                                              weights is not None, with_reference)
+        gradient = _flatGradient(self.policy)
+        dist.all_reduce(gradient)
+        dist.all_reduce(sample_stats)
+        self.in_collective = False
+
+        offset = 0
+        for param in self.policy.parameters():
+            param.grad = gradient[offset:offset + param.numel()].view_as(param)
+            offset += param.numel()
+        sample_losses = sample_stats[0]
+        loss = (weights * sample_losses).sum() if weights is not None else sample_losses.sum()
+        return loss, sample_losses, sample_stats[1] if with_reference else None
+
+    def close(self):
+        """Stops the other ranks, which are killed if a collective operation was interrupted."""
+        if self.in_collective:
+            for process in self.processes:
+                process.kill()
+        else:
+            dist.broadcast(torch.tensor([_STOP, 0, 0, 0, 0], dtype=torch.int64), src=0)
+            for process in self.processes:
+                process.join()
+        dist.destroy_process_group()
@@ -0,0 +1,337 @@
+import atexit
+import copy
+import multiprocessing
+import multiprocessing.util
+import queue
+import signal
+import time
+import traceback
+import numpy as np
+import torch
+
+import profiling
+from ballbot_backend import mpc_interface, scalar_array, state_vector_array, input_vector_array, dynamic_vector_array, cost_desired_trajectories
+from simulator import Simulator
+
+
+def getTargetTrajectories(mpc):
+    desiredTimeTraj = scalar_array()
+    desiredTimeTraj.resize(1)
+    desiredTimeTraj[0] = 2.0
+
+    desiredInputTraj = dynamic_vector_array()
+    desiredInputTraj.resize(1)
+    desiredInputTraj[0] = np.zeros((mpc.INPUT_DIM, 1))
+
+    desiredStateTraj = dynamic_vector_array()
+    desiredStateTraj.resize(1)
+    desiredStateTraj[0] = np.zeros((mpc.STATE_DIM, 1))
+
+    return cost_desired_trajectories(desiredTimeTraj, desiredStateTraj, desiredInputTraj)
+
+
+def workerContext():
+    """Multiprocessing context of the worker processes, fork, as the learner is a script and would be re-executed."""
+    return multiprocessing.get_context("fork")
+
+
+def initWorkerProcess(ignore_sigterm=True):
+    """
+    Prologue of every worker process. The parent handles Ctrl-C and shuts its workers down, so SIGINT is ignored,
+    and so is SIGTERM unless ignore_sigterm is cleared, so that a preemption only reaches the parent.
+    Workers ignoring SIGTERM have to be stopped with Process.kill() instead of terminate().
+    :return: mpc_interface of the worker, reset to the target trajectories
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if ignore_sigterm:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    torch.set_num_threads(1)
+    mpc = mpc_interface("mpc", False)
+    mpc.reset(getTargetTrajectories(mpc))
+    return mpc
+
+
+def _killWorkers():
+    # multiprocessing terminates and then joins daemonic children at exit, which would wait forever for workers
+    # that ignore SIGTERM. Registered after multiprocessing.util, so that atexit runs it first.
+    for process in multiprocessing.active_children():
+        if process.daemon:
+            process.kill()
+
+
+atexit.register(_killWorkers)
+
+
+def num_samples_per_trajectory_point(t, max_num_points, half_value_decay_t):
+    """
+    Calculates number of samples drawn for each nominal state point in trajectory
+    :param t: Query time along trajectory
+    :param max_num_points:
+    :param half_value_decay_t: time into trajectory after which number of sampled point is halfed
+    :return: Number of samples to be drawn
+    """
+    return max_num_points * np.exp(-np.log(2) * t / half_value_decay_t)
+
+
+def perturbedStates(x_nominal, num_samples, std):
+    """
+    Draws the states sampled around a nominal state in one go, the first row being the nominal state itself.
+    :param std: Standard deviation of the independent gaussian perturbation of each state dimension
+    :return: Array of shape (num_samples, len(x_nominal))
+    """
+    x_nominal = np.reshape(x_nominal, -1)
+    x = np.empty((num_samples, len(x_nominal)))
+    x[:] = x_nominal
+    x[1:] += std * np.random.standard_normal((max(num_samples - 1, 0), len(x_nominal)))
+    return x
+
+
+class CollectionEngine(object):
+    """
+    Collects MPC samples with one mpc_interface, reusing the solution containers across all MPC steps.
+
+    Besides the first point of every MPC solution, points further along the returned horizon can be sampled
+    as well, every horizon_stride-th point with a number of samples that decays along the horizon.
+    With chain_trajectories, a trajectory starts from a perturbation of the state the previous one ended in
+    without resetting the MPC, so that its solver stays warm started. The MPC time then keeps running across
+    trajectories, while the pushed sample times and the policy inputs stay relative to the trajectory start.
+    After chain_length trajectories, the MPC is reset to a random initial state again, so that chained
+    trajectories do not all end up near the equilibrium.
+    """
+
+    def __init__(self, mpc, targetTrajectories, systemHasConstraints=False, max_num_points=4,
+                 perturbation_std=np.sqrt(0.1), horizon_stride=0, horizon_half_value_decay_t=1e10,
+                 chain_trajectories=False, chain_length=5):
+        """
+        :param max_num_points: Number of samples pushed per solution point, including the nominal state
+        :param perturbation_std: Standard deviation of the state perturbations around the solution points
+        :param horizon_stride: Number of solution points between sampled horizon points, 0 samples only the first
+        :param horizon_half_value_decay_t: Time into the horizon after which half as many samples are drawn
+        :param chain_trajectories: Warm start each trajectory from the end of the previous one
+        :param chain_length: Number of trajectories between two resets of the MPC if trajectories are chained
+        """
+        self.mpc = mpc
+        self.targetTrajectories = targetTrajectories
+        self.systemHasConstraints = systemHasConstraints
+        self.max_num_points = max_num_points
+        self.perturbation_std = perturbation_std
+        self.horizon_stride = horizon_stride
+        self.horizon_half_value_decay_t = horizon_half_value_decay_t
+        self.chain_trajectories = chain_trajectories
+        self.chain_length = chain_length
+        self.t_result = scalar_array()
+        self.x_result = state_vector_array()
+        self.u_result = input_vector_array()
+        self.time_offset = 0.0
+        self.x_end = None  # state the last trajectory ended in, None if the MPC has to be reset
+        self.chain_position = 0  # trajectories since the last reset, including the current one
+
+    def _initialState(self):
+        if self.chain_trajectories and self.x_end is not None and self.chain_position < self.chain_length:
+            self.chain_position += 1
+            return perturbedStates(self.x_end, 2, self.perturbation_std)[1]
+        self.mpc.reset(self.targetTrajectories)
+        self.time_offset = 0.0
+        self.chain_position = 1
+        print("resetting MPC")
+        x0 = np.zeros(self.mpc.STATE_DIM)
+        x0[0] = np.random.uniform(-0.5, 0.5) # base x
+        x0[1] = np.random.uniform(-0.5, 0.5) # base y
+        return x0
+
+    def _samplePoints(self, mem):
+        """Pushes the samples around the sampled points of the current MPC solution as one block."""
+        mpc = self.mpc
+        t_start = self.t_result[0]
+        points = range(0, len(self.t_result), self.horizon_stride) if self.horizon_stride > 0 else [0]
+        t, x, dVdx, nu, u0 = [], [], [], [], []
+        for k in points:
+            t_k = self.t_result[k]
+            num_samples = int(round(num_samples_per_trajectory_point(t_k - t_start, self.max_num_points,
+                                                                     self.horizon_half_value_decay_t)))
+            if num_samples == 0:
+                break
+            x_k = perturbedStates(self.x_result[k], num_samples, self.perturbation_std)
+            K = mpc.getLinearFeedbackGain(t_k)
+            t.append(np.full(num_samples, t_k - self.time_offset))
+            x.append(x_k)
+            dVdx.append(np.stack([mpc.getValueFunctionStateDerivative(t_k, x_i) for x_i in x_k]).reshape((num_samples, -1)))
+            if self.systemHasConstraints:
+                nu.append(np.stack([mpc.getStateInputConstraintLagrangian(t_k, x_i) for x_i in x_k]).reshape((num_samples, -1)))
+            u0.append(np.reshape(self.u_result[k], -1) + (x_k - x_k[0]).dot(K.T))
+        if not x:
+            return
+        mem.push_batch(np.concatenate(t), np.concatenate(x), np.concatenate(dVdx),
+                       np.concatenate(nu) if self.systemHasConstraints else None, np.concatenate(u0))
+
+    def collectTrajectory(self, policy, alpha_mix, mem, traj_len_sec, dt_control):
+        """
+        Runs the MPC for traj_len_sec and pushes samples around its solutions into mem.
+        The system is propagated with a blend of MPC and policy inputs, alpha_mix being the proportion of MPC.
+        :param mem: Anything with the push_batch interface of ReplayMemory
+        """
+        mpc = self.mpc
+        simulator = Simulator(mpc, self._initialState(), dt_control)
+        print("proportion of MPC policy is", alpha_mix)
+        print("starting from", simulator.x)
+
+        frozen_policy = policy.freeze()
+        self.x_end = None
+        mpc_traj_t = np.linspace(0.0, traj_len_sec, int(traj_len_sec/dt_control))
+        for mpc_time in mpc_traj_t: # mpc dummy loop
+            mpc.setObservation(self.time_offset + mpc_time, simulator.x[0].reshape((mpc.STATE_DIM, 1)))
+            try:
+                with profiling.stage("mpc_solve"):
+                    mpc.advanceMpc()
+            except RuntimeError:
+                print("Caught error in MPC advance!!")
+                break
+            mpc.getMpcSolution(self.t_result, self.x_result, self.u_result)
+            with profiling.stage("mpc_sampling"):
+                self._samplePoints(mem)
+            profiling.count("mpc_steps")
+
+            # increment state for next time step
+            frozen_policy.input[0] = mpc_time
+            frozen_policy.input[1:] = self.x_result[0]
+            u_net = frozen_policy.evaluate()
+
+            u_mixed = alpha_mix * self.u_result[0] + (1.0 - alpha_mix) * u_net
+            simulator.step(u_mixed)
+        else:
+            if np.all(np.isfinite(simulator.x)):
+                self.x_end = simulator.x[0].copy()
+        self.time_offset += traj_len_sec
+
+        if len(self.x_result) > 0:
+            print("mpc ended up at", self.x_result[0])
+
+
+class _QueueWriter(object):
+    """Stand-in for the replay memory inside a worker, sends pushed samples to the learner in blocks."""
+
+    def __init__(self, sample_queue, block_size):
+        self.sample_queue = sample_queue
+        self.block_size = block_size
+        self.blocks = []
+        self.num_rows = 0
+
+    def push_batch(self, t, x, dVdx, nu, u0):
+        self.blocks.append((t, x, dVdx, nu, u0))
+        self.num_rows += len(t)
+        if self.num_rows >= self.block_size:
+            self.send()
+
+    def send(self):
+        if not self.blocks:
+            return
+        t, x, dVdx, nu, u0 = zip(*self.blocks)
+        self.sample_queue.put((np.concatenate(t), np.concatenate(x), np.concatenate(dVdx),
+                               np.concatenate(nu) if nu[0] is not None else None, np.concatenate(u0)))
+        self.blocks = []
+        self.num_rows = 0
+
+
+def _collectionWorker(seed, shared_policy, alpha_mix, sample_queue, stop_event, traj_len_sec, dt_control,
+                      systemHasConstraints, block_size, engine_options, max_consecutive_failures):
+    np.random.seed(seed)
+    mpc = initWorkerProcess()
+    engine = CollectionEngine(mpc, getTargetTrajectories(mpc), systemHasConstraints, **engine_options)
+    policy = copy.deepcopy(shared_policy)
+    writer = _QueueWriter(sample_queue, block_size)
+    consecutive_failures = 0
+    while not stop_event.is_set():
+        # private copy of the latest published weights, they stay fixed for the whole trajectory
+        policy.load_state_dict(shared_policy.state_dict())
+        try:
+            engine.collectTrajectory(policy, alpha_mix.value, writer, traj_len_sec, dt_control)
+            writer.send()
+            consecutive_failures = 0
+        except Exception:  # a failed trajectory must not end the collection, a persistent error ends the worker
+            consecutive_failures += 1
+            print("Collection worker failed on a trajectory,", consecutive_failures, "failures in a row")
+            traceback.print_exc()
+            if consecutive_failures >= max_consecutive_failures:
+                print("Collection worker gives up")
+                return
+
+
+class CollectionWorkers(object):
+    """
+    Runs MPC data collection in num_workers background processes, each with its own mpc_interface.
+    The workers read the policy weights and alpha_mix published by the learner through shared memory and
+    stream sample blocks back through a queue, which the learner moves into its replay memory with drain().
+    A worker whose trajectories keep failing exits, drain() warns about it and raises once no worker is left.
+    """
+
+    def __init__(self, policy, num_workers, traj_len_sec, dt_control, systemHasConstraints=False, block_size=400,
+                 max_queued_blocks=64, engine_options=None, max_consecutive_failures=3):
+        """
+        :param engine_options: Keyword arguments of the CollectionEngine of each worker
+        :param max_consecutive_failures: Failed trajectories in a row after which a worker exits
+        """
+        ctx = workerContext()
+        self.shared_policy = copy.deepcopy(policy).cpu().share_memory()
+        self.alpha_mix = ctx.Value('d', 1.0)
+        self.sample_queue = ctx.Queue(maxsize=max_queued_blocks)
+        self.stop_event = ctx.Event()
+        self.processes = [ctx.Process(target=_collectionWorker,
+                                      args=(np.random.randint(2**31), self.shared_policy, self.alpha_mix,
+                                            self.sample_queue, self.stop_event, traj_len_sec, dt_control,
+                                            systemHasConstraints, block_size, engine_options or {},
+                                            max_consecutive_failures),
+                                      daemon=True)
+                          for _ in range(num_workers)]
+        self.num_dead = 0
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def publish(self, policy, alpha_mix):
+        """Makes the current policy weights and mixing proportion visible to the workers."""
+        self.shared_policy.load_state_dict(policy.state_dict())
+        self.alpha_mix.value = alpha_mix
+
+    def checkWorkers(self):
+        """Warns about workers that exited since the last check, raises RuntimeError if none is running."""
+        alive = [process.is_alive() for process in self.processes]
+        num_dead = alive.count(False)
+        if num_dead > self.num_dead:
+            print("Warning:", num_dead, "of", len(self.processes), "collection workers have exited, see their output")
+            self.num_dead = num_dead
+        if not any(alive):
+            raise RuntimeError("All collection workers have exited, the replay memory no longer receives samples")
+
+    def drain(self, mem, block=False, timeout=1.0):
+        """
+        Moves all sample blocks received so far into mem, waits for at least one if block is set.
+        :param timeout: Seconds between two checks of the workers while waiting
+        """
+        self.checkWorkers()
+        num_samples = 0
+        while True:
+            try:
+                samples = self.sample_queue.get(block=block and num_samples == 0, timeout=timeout)
+            except queue.Empty:
+                if block and num_samples == 0:
+                    self.checkWorkers()
+                    continue
+                return num_samples
+            mem.push_batch(*samples)
+            num_samples += len(samples[0])
+
+    def stop(self, timeout=10.0):
+        """Lets the workers finish their current trajectory, kills those still running after timeout."""
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        for process in self.processes:
+            # keep the queue empty so that workers blocked in put() can finish
+            while process.is_alive() and time.time() < deadline:
+                try:
+                    self.sample_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                process.join(timeout=0.1)
+            if process.is_alive():
+                process.kill()
@@ -0,0 +1,43 @@
+import time
+import torch
+
+
+def writeParameterSummaries(writer, named_parameters, it):
+    """
+    Writes a histogram and the norm, min, max and number of NaNs of every parameter tensor.
+    The statistics of all tensors are gathered into a single tensor so that only one device sync is needed.
+    """
+    named_parameters = [(name, param.detach()) for name, param in named_parameters]
+    with torch.no_grad():
+        stats = torch.stack([torch.stack((param.norm(), param.min(), param.max(), torch.isnan(param).sum().to(param.dtype)))
+                             for _, param in named_parameters]).cpu().tolist()
+    for (name, param), (norm, minimum, maximum, num_nan) in zip(named_parameters, stats):
+        writer.add_histogram(name, param.cpu().numpy(), it)
+        writer.add_scalar(name + "/norm", norm, it)
+        writer.add_scalar(name + "/min", minimum, it)
+        writer.add_scalar(name + "/max", maximum, it)
+        writer.add_scalar(name + "/nan_count", num_nan, it)
+
+
+class ParameterLogger(object):
+    """
+    Rate limited parameter logging, writes the summaries of a policy at most every `every` iterations
+    and no more often than once per min_interval_sec seconds.
+    """
+
+    def __init__(self, writer, every=1000, min_interval_sec=60.0):
+        self.writer = writer
+        self.every = every
+        self.min_interval_sec = min_interval_sec
+        self.last_write_time = None
+
+    def log(self, policy, it):
+        """:return: True if the parameters were written in this call"""
+        if self.every <= 0 or it % self.every != 0:
+            return False
+        now = time.time()
+        if self.last_write_time is not None and now - self.last_write_time < self.min_interval_sec:
+            return False
+        self.last_write_time = now
+        policy.logParameters(self.writer, it)
+        return True
@@ -0,0 +1,135 @@
+"""
+Stage-level timers and counters for the training loop.
+
+Code is instrumented with the process-wide profiler through the module functions, e.g.
+    with profiling.stage("mpc_solve"):
+        mpc.advanceMpc()
+    profiling.count("samples_pushed", n)
+The profiler is disabled until configure() is called. While disabled, stage() returns a shared no-op context
+manager and count() returns immediately.
+"""
+import json
+import time
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, durations, max_samples):
+        self.durations = durations
+        self.max_samples = max_samples
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.durations.append(time.perf_counter() - self.start)
+        if len(self.durations) > self.max_samples:
+            del self.durations[:self.max_samples // 2]  # keep the memory bounded if nobody flushes
+        return False
+
+
+class StageProfiler(object):
+    """
+    Collects the durations of named stages and the totals of named counters between two flushes,
+    and writes their percentiles to TensorBoard and as one JSON line per flush to a file.
+    """
+
+    def __init__(self, enabled=False, writer=None, json_path=None, flush_interval_sec=60.0, max_samples=100000):
+        self.enabled = enabled
+        self.writer = writer
+        self.json_path = json_path
+        self.flush_interval_sec = flush_interval_sec
+        self.max_samples = max_samples
+        self.durations = {}
+        self.counters = {}
+        self.last_flush_time = time.time()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations[name] = []
+        return _Stage(durations, self.max_samples)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """:return: dict with the count, total and percentiles in milliseconds of every stage, and the counters"""
+        stages = {}
+        for name, durations in self.durations.items():
+            if not durations:
+                continue
+            milliseconds = 1e3 * np.array(durations)
+            stages[name] = {"count": len(durations), "total_ms": float(milliseconds.sum())}
+            for percentile, value in zip(PERCENTILES, np.percentile(milliseconds, PERCENTILES)):
+                stages[name]["p{}_ms".format(percentile)] = float(value)
+        return {"stages": stages, "counters": dict(self.counters)}
+
+    def flush(self, it, force=False):
+        """
+        Writes and resets the statistics gathered since the last flush, if flush_interval_sec has passed.
+        :return: True if the statistics were written in this call
+        """
+        if not self.enabled:
+            return False
+        now = time.time()
+        if not force and now - self.last_flush_time < self.flush_interval_sec:
+            return False
+        summary = self.summary()
+        elapsed = now - self.last_flush_time
+        if self.writer is not None:
+            for name, stats in summary["stages"].items():
+                for key, value in stats.items():
+                    self.writer.add_scalar("profile/" + name + "/" + key, value, it)
+                self.writer.add_scalar("profile/" + name + "/time_share", 1e-3 * stats["total_ms"] / elapsed, it)
+            for name, value in summary["counters"].items():
+                self.writer.add_scalar("profile/" + name + "/per_sec", value / elapsed, it)
+        if self.json_path is not None:
+            summary.update({"iteration": it, "time": now, "elapsed_sec": elapsed})
+            with open(self.json_path, 'a') as jsonFile:
+                jsonFile.write(json.dumps(summary) + "\n")
+        for durations in self.durations.values():
+            del durations[:]
+        self.counters = {}
+        self.last_flush_time = now
+        return True
+
+
+_profiler = StageProfiler(enabled=False)
+
+
+def configure(enabled=True, writer=None, json_path=None, flush_interval_sec=60.0):
+    """Replaces the process-wide profiler, returns the new one."""
+    global _profiler
+    _profiler = StageProfiler(enabled, writer, json_path, flush_interval_sec)
+    return _profiler
+
+
+def stage(name):
+    return _profiler.stage(name)
+
+
+def count(name, n=1):
+    _profiler.count(name, n)
+
+
+def flush(it, force=False):
+    return _profiler.flush(it, force)
@@ -1,31 +1,287 @@
 from sample import Sample
-import random
+from training_state import atomicWrite
+import json
+import os
+import threading
 import numpy as np
+import torch
 
 
 class ReplayMemory(object):
+    """
+    Ring buffer of training samples stored column-wise in preallocated contiguous arrays.
+    Samples are drawn uniformly with replacement and returned as a Sample of stacked tensors.
 
-    def __init__(self, capacity):
+    If a path is given, every column is a memory-mapped .npy file in that directory and pushed samples
+    are written straight to disk. Together with a small meta.json that flush() keeps up to date, this allows
+    buffers larger than RAM and reopening a buffer in O(1) with ReplayMemory.load(path).
+
+    Pushing and sampling are serialized by a lock, so that batches can be drawn from another thread.
+    """
+
+    def __init__(self, capacity, state_dim, input_dim, constraint_dim=0, dtype=np.float32, path=None):
         self.capacity = capacity
-        self.memory = [None] * capacity  # pre-allocate memory
+        self.state_dim = state_dim
+        self.input_dim = input_dim
+        self.constraint_dim = constraint_dim
+        self.dtype = np.dtype(dtype)
+        self.path = path
         self.position = 0
         self.size = 0
+        self.lock = threading.RLock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self._createColumns(mode='w+')
+        if path is not None:
+            self.flush()
+
+    @classmethod
+    def load(cls, path, copy=False, meta_path=None):
+        """
+        Opens a buffer written with a path or by save(). The columns are memory-mapped, not read.
+        :param copy: Read the columns into RAM instead, the buffer is then independent of the files in path
+        :param meta_path: Directory written by saveMeta(), whose size and position replace those in path
+        """
+        with open(os.path.join(meta_path or path, "meta.json"), 'r') as metaFile:
+            meta = json.load(metaFile)
+        mem = cls.__new__(cls)
+        mem.capacity = meta["capacity"]
+        mem.state_dim = meta["state_dim"]
+        mem.input_dim = meta["input_dim"]
+        mem.constraint_dim = meta["constraint_dim"]
+        mem.dtype = np.dtype(meta["dtype"])
+        mem.path = path
+        mem.position = meta["position"]
+        mem.size = meta["size"]
+        mem.lock = threading.RLock()
+        mem._createColumns(mode='r' if copy else 'r+')
+        if copy:
+            for name in ("t", "x", "dVdx", "nu", "u0"):
+                if getattr(mem, name) is not None:
+                    setattr(mem, name, np.array(getattr(mem, name)))
+            mem.path = None
+        return mem
+
+    def _createColumns(self, mode):
+        def column(name, shape):
+            if self.path is None:
+                return np.zeros(shape, dtype=self.dtype)
+            return np.lib.format.open_memmap(os.path.join(self.path, name + ".npy"), mode=mode, dtype=self.dtype, shape=shape)
+
+        self.t = column("t", (self.capacity,))
+        self.x = column("x", (self.capacity, self.state_dim))
+        self.dVdx = column("dVdx", (self.capacity, self.state_dim))
+        self.nu = column("nu", (self.capacity, self.constraint_dim)) if self.constraint_dim > 0 else None
+        self.u0 = column("u0", (self.capacity, self.input_dim))
+
+    def _meta(self):
+        return {"capacity": self.capacity, "state_dim": self.state_dim, "input_dim": self.input_dim,
+                "constraint_dim": self.constraint_dim, "dtype": self.dtype.str,
+                "position": self.position, "size": self.size}
+
+    @staticmethod
+    def _writeMeta(path, meta):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as metaFile:
+                json.dump(meta, metaFile)
+
+        atomicWrite(os.path.join(path, "meta.json"), write)
 
-    def push(self, *args):
+    def flush(self):
+        """Writes pending samples of a disk-backed buffer to disk, then records its size and position."""
+        with self.lock:
+            if self.path is None:
+                return
+            for column in (self.t, self.x, self.dVdx, self.nu, self.u0):
+                if column is not None:
+                    column.flush()
+            self._writeMeta(self.path, self._meta())
+
+    def saveMeta(self, path):
+        """
+        Writes the current size and position of the buffer to a directory, without the columns.
+        Used to snapshot a disk-backed buffer, whose columns are then reopened with load(self.path, meta_path=path).
+        """
+        with self.lock:
+            os.makedirs(path, exist_ok=True)
+            self._writeMeta(path, self._meta())
+
+    def save(self, path):
+        """Writes the buffer to a directory in the format understood by load()."""
+        with self.lock:
+            if path == self.path:
+                self.flush()
+            else:
+                os.makedirs(path, exist_ok=True)
+                for name in ("t", "x", "dVdx", "nu", "u0"):
+                    column = getattr(self, name)
+                    if column is not None:
+                        np.save(os.path.join(path, name + ".npy"), column)
+            self.saveMeta(path)
+
+    def push(self, t, x, dVdx, nu, u0):
         """Saves a sample."""
-        sample = Sample(*args)
-        for elem in sample:
-            if elem is not None:
-                if np.any(np.isnan(elem)):
-                    print("Avoided pushing NaN into memory", elem)
-                    return
+        self.push_batch(np.reshape(t, (1,)),
+                        np.reshape(x, (1, -1)),
+                        np.reshape(dVdx, (1, -1)),
+                        np.reshape(nu, (1, -1)) if nu is not None else None,
+                        np.reshape(u0, (1, -1)))
+
+    def push_batch(self, t, x, dVdx, nu, u0):
+        """
+        Saves a block of N samples, given as arrays with leading dimension N. Rows containing NaN are dropped.
+        :return: Indices of the buffer rows that were written
+        """
+        valid = ~(np.isnan(t) | np.isnan(x).any(axis=1) | np.isnan(dVdx).any(axis=1) | np.isnan(u0).any(axis=1))
+        if nu is not None:
+            valid &= ~np.isnan(nu).any(axis=1)
+        if not valid.all():
+            print("Avoided pushing", np.count_nonzero(~valid), "samples with NaN into memory")
+            t, x, dVdx, u0 = t[valid], x[valid], dVdx[valid], u0[valid]
+            nu = nu[valid] if nu is not None else None
 
-        self.size = min(self.size + 1, self.capacity)
-        self.memory[self.position] = sample
-        self.position = (self.position + 1) % self.capacity
+        with self.lock:
+            num_samples = min(len(t), self.capacity)  # only the most recent samples survive an overflowing block
+            indices = (self.position + np.arange(num_samples)) % self.capacity
+            self.t[indices] = t[-num_samples:]
+            self.x[indices] = x[-num_samples:]
+            self.dVdx[indices] = dVdx[-num_samples:]
+            if self.nu is not None:
+                self.nu[indices] = nu[-num_samples:]
+            self.u0[indices] = u0[-num_samples:]
 
-    def sample(self, batch_size):
-        return random.sample(self.memory[0:self.size], batch_size)
+            self.size = min(self.size + num_samples, self.capacity)
+            self.position = (self.position + num_samples) % self.capacity
+            return indices
+
+    def sample(self, batch_size, device=None, dtype=None):
+        """Draws batch_size samples in O(batch_size) and returns them as a Sample of stacked tensors."""
+        with self.lock:
+            indices = np.random.randint(0, self.size, size=batch_size)
+            return self.gather(indices, device, dtype)
+
+    def gather(self, indices, device=None, dtype=None):
+        def toTensor(column):
+            if column is None:
+                return None
+            tensor = torch.from_numpy(column[indices])
+            if device is None and dtype is None:
+                return tensor
+            return tensor.to(device=device if device is not None else tensor.device,
+                             dtype=dtype if dtype is not None else tensor.dtype)
+        return Sample(toTensor(self.t), toTensor(self.x), toTensor(self.dVdx), toTensor(self.nu), toTensor(self.u0))
 
     def __len__(self):
         return self.size
+
+
+class SumTree(object):
+    """
+    Complete binary tree over a fixed number of non-negative leaf values, each node holding the sum of its
+    children. Updating and sampling a batch of B leaves both take O(B log n) and are vectorized over the batch.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.num_leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.nodes = np.zeros(2 * self.num_leaves)  # nodes[1] is the root, the leaves start at num_leaves
+
+    def total(self):
+        return self.nodes[1]
+
+    def __getitem__(self, indices):
+        return self.nodes[self.num_leaves + np.asarray(indices)]
+
+    def update(self, indices, values):
+        """Sets the leaves at indices to values and recomputes the sums on their paths to the root."""
+        nodes = np.unique(self.num_leaves + np.asarray(indices, dtype=np.int64))  # the last value wins for duplicates
+        if len(nodes) == 0:
+            return
+        self.nodes[self.num_leaves + np.asarray(indices, dtype=np.int64)] = values
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the index of the leaf whose cumulative sum interval contains each of the given values."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.num_leaves:
+            left = self.nodes[2 * nodes]
+            # never descend into an empty subtree, values rounded up to the total would end on an empty leaf
+            go_right = (values >= left) & (self.nodes[2 * nodes + 1] > 0.0)
+            values -= np.where(go_right, left, 0.0)
+            nodes = 2 * nodes + go_right
+        return nodes - self.num_leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    ReplayMemory that in addition draws samples with probability proportional to priority^alpha, the priority
+    of a sample being the magnitude of its last loss. New samples get the highest priority seen so far, so
+    that each of them is drawn at least once before its priority is known.
+    Priorities are kept in RAM and only written by save() and saveMeta(). A buffer loaded without them
+    starts with equal priorities for all samples.
+    """
+
+    def __init__(self, capacity, state_dim, input_dim, constraint_dim=0, dtype=np.float32, path=None,
+                 alpha=0.6, beta=0.4, epsilon=1e-6):
+        super(PrioritizedReplayMemory, self).__init__(capacity, state_dim, input_dim, constraint_dim, dtype, path)
+        self._initPriorities(alpha, beta, epsilon)
+
+    @classmethod
+    def load(cls, path, copy=False, meta_path=None, alpha=0.6, beta=0.4, epsilon=1e-6):
+        mem = super(PrioritizedReplayMemory, cls).load(path, copy, meta_path)
+        mem._initPriorities(alpha, beta, epsilon)
+        priorities_path = os.path.join(meta_path or path, "priorities.npy")
+        if os.path.exists(priorities_path):
+            priorities = np.load(priorities_path)
+            mem.max_priority = max(mem.max_priority, float(priorities.max(initial=0.0)))
+        else:
+            priorities = np.ones(mem.size)
+        mem.priorities.update(np.arange(len(priorities)), priorities)
+        return mem
+
+    def saveMeta(self, path):
+        with self.lock:
+            super(PrioritizedReplayMemory, self).saveMeta(path)
+            np.save(os.path.join(path, "priorities.npy"), self.priorities[np.arange(self.size)])
+
+    def _initPriorities(self, alpha, beta, epsilon):
+        self.alpha = alpha
+        self.beta = beta  # exponent of the importance sampling correction, usually annealed towards 1
+        self.epsilon = epsilon
+        self.priorities = SumTree(self.capacity)
+        self.max_priority = 1.0
+
+    def push_batch(self, t, x, dVdx, nu, u0):
+        with self.lock:
+            indices = super(PrioritizedReplayMemory, self).push_batch(t, x, dVdx, nu, u0)
+            self.priorities.update(indices, np.full(len(indices), self.max_priority))
+            return indices
+
+    def sample_prioritized(self, batch_size, device=None, dtype=None):
+        """
+        Draws batch_size samples in O(batch_size log capacity), one from each of batch_size equally probable
+        strata of the priority distribution.
+        :return: (Sample of stacked tensors, indices for update_priorities, importance sampling weights (B,))
+        """
+        with self.lock:
+            total = self.priorities.total()
+            values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (total / batch_size)
+            indices = self.priorities.find(values)
+            probabilities = self.priorities[indices] / total
+            samples = self.gather(indices, device, dtype)
+        weights = (self.size * probabilities) ** -self.beta
+        weights = torch.from_numpy((weights / weights.max()).astype(self.dtype))  # normalized by the batch maximum
+        if device is not None or dtype is not None:
+            weights = weights.to(device=device if device is not None else weights.device,
+                                 dtype=dtype if dtype is not None else weights.dtype)
+        return samples, indices, weights
+
+    def update_priorities(self, indices, losses):
+        """Sets the priorities of the samples at indices from their latest per-sample losses."""
+        priorities = (np.abs(losses) + self.epsilon) ** self.alpha
+        with self.lock:
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+            self.priorities.update(indices, priorities)
@@ -1,4 +1,4 @@
 from collections import namedtuple
 
 Sample = namedtuple('Sample',
-                    ('t', 'x', 'dVdx', 'dVdx0', 'nu', 'B', 'u0'))
+                    ('t', 'x', 'dVdx', 'nu', 'u0'))
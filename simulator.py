@@ -0,0 +1,89 @@
+import numpy as np
+
+INTEGRATORS = ("euler", "rk4")
+
+
+def flowMapBatch(mpc, t, x, u):
+    """
+    Evaluates the dynamics at N points, t (N,), x (N, STATE_DIM) and u (N, INPUT_DIM).
+    Uses computeFlowMapBatch if the backend provides one and calls computeFlowMap per point otherwise.
+    """
+    if hasattr(mpc, "computeFlowMapBatch"):
+        return mpc.computeFlowMapBatch(t, x, u)
+    return np.stack([np.reshape(mpc.computeFlowMap(t[i], x[i], u[i]), -1) for i in range(len(t))])
+
+
+def intermediateCostBatch(mpc, t, x, u):
+    """Evaluates the running cost at N points, uses getIntermediateCostBatch if the backend provides one."""
+    if hasattr(mpc, "getIntermediateCostBatch"):
+        return mpc.getIntermediateCostBatch(t, x, u)
+    return np.array([mpc.getIntermediateCost(t[i], x[i], u[i]) for i in range(len(t))])
+
+
+class Simulator(object):
+    """
+    Propagates N copies of the system of an mpc_interface in lockstep, holding the inputs constant over
+    each control interval of length dt, which is integrated in substeps explicit Euler or RK4 steps.
+
+    The time and state of all systems live in one (N, 1 + STATE_DIM) array tx, which is the layout of the
+    policy input, with t and x being views of its columns. If history_length is given, tx is recorded after
+    every step into a buffer preallocated for that many rows, which history() returns.
+    """
+
+    def __init__(self, mpc, x0, dt, t0=0.0, integrator="euler", substeps=1, history_length=0):
+        if integrator not in INTEGRATORS:
+            raise ValueError("Unknown integrator " + str(integrator) + ", choose one of " + str(INTEGRATORS))
+        self.mpc = mpc
+        self.dt = dt
+        self.integrator = integrator
+        self.substeps = substeps
+        x0 = np.reshape(x0, (-1, mpc.STATE_DIM))
+        self.tx = np.empty((len(x0), 1 + mpc.STATE_DIM))
+        self.tx[:, 0] = t0
+        self.tx[:, 1:] = x0
+        self.t = self.tx[:, 0]
+        self.x = self.tx[:, 1:]
+        self.history_buffer = np.empty((history_length, len(x0), 1 + mpc.STATE_DIM)) if history_length > 0 else None
+        self.history_size = 0
+        self._record()
+
+    def __len__(self):
+        return len(self.tx)
+
+    def _record(self):
+        if self.history_buffer is not None and self.history_size < len(self.history_buffer):
+            self.history_buffer[self.history_size] = self.tx
+            self.history_size += 1
+
+    def history(self):
+        """:return: View of the recorded (T, N, 1 + STATE_DIM) history, None if no history was requested"""
+        if self.history_buffer is None:
+            return None
+        return self.history_buffer[:self.history_size]
+
+    def _increment(self, t, x, u, h):
+        f = flowMapBatch(self.mpc, t, x, u)
+        if self.integrator == "euler":
+            return h * f
+        k2 = flowMapBatch(self.mpc, t + 0.5 * h, x + 0.5 * h * f, u)
+        k3 = flowMapBatch(self.mpc, t + 0.5 * h, x + 0.5 * h * k2, u)
+        k4 = flowMapBatch(self.mpc, t + h, x + h * k3, u)
+        return h / 6.0 * (f + 2.0 * k2 + 2.0 * k3 + k4)
+
+    def step(self, u, active=None):
+        """
+        Advances the systems by dt with the inputs u (N, INPUT_DIM).
+        :param active: Optional boolean mask (N,) of the systems to advance, the others keep their time and state
+        """
+        u = np.reshape(u, (len(self), -1))
+        rows = slice(None) if active is None else np.flatnonzero(active)
+        t, x, u = self.t[rows], self.x[rows], u[rows]
+        if len(t) == 0:
+            return
+        h = self.dt / self.substeps
+        for _ in range(self.substeps):
+            x = x + self._increment(t, x, u, h)
+            t = t + h
+        self.x[rows] = x
+        self.t[rows] = t
+        self._record()
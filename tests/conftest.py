@@ -0,0 +1,35 @@
+"""
+The tests run against the NumPy ballbot stand-in unless MPCNET_BACKEND is set explicitly, see ballbot_backend.py.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+os.environ.setdefault("MPCNET_BACKEND", "local")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ballbot_backend import mpc_interface
+from mpc_collection import CollectionEngine, getTargetTrajectories
+from PolicyNet import ExpertMixturePolicy
+from replay_memory import ReplayMemory
+
+
+@pytest.fixture(scope="session")
+def mpc():
+    mpc = mpc_interface("mpc", False)
+    mpc.reset(getTargetTrajectories(mpc))
+    return mpc
+
+
+@pytest.fixture(scope="session")
+def memory():
+    """Replay memory of MPC samples from two short trajectories, collected with a separate mpc_interface."""
+    np.random.seed(0)
+    collection_mpc = mpc_interface("mpc", False)
+    mem = ReplayMemory(10000, collection_mpc.STATE_DIM, collection_mpc.INPUT_DIM, dtype=np.float64)
+    engine = CollectionEngine(collection_mpc, getTargetTrajectories(collection_mpc))
+    policy = ExpertMixturePolicy(collection_mpc.STATE_DIM + 1, collection_mpc.INPUT_DIM)
+    for _ in range(2):
+        engine.collectTrajectory(policy, 1.0, mem, 1.0, 1.0 / 400.)
+    return mem
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+import torch
+
+import PolicyNet
+from PolicyNet import POLICY_CLASSES
+
+
+@pytest.mark.parametrize("policy_class", POLICY_CLASSES)
+def test_frozen_policy_matches_action(mpc, policy_class):
+    # collection and plotting only run the frozen copy, it has to follow every change of the forward pass
+    torch.manual_seed(0)
+    policy = getattr(PolicyNet, policy_class)(mpc.STATE_DIM + 1, mpc.INPUT_DIM).double()
+    frozen_policy = policy.freeze()
+    tx = np.random.RandomState(0).normal(size=(16, mpc.STATE_DIM + 1))
+    with torch.no_grad():
+        u = policy.action(torch.from_numpy(tx)).numpy()
+    for i in range(len(tx)):
+        np.testing.assert_allclose(frozen_policy(tx[i]), u[i], rtol=1e-12, atol=1e-12)
@@ -0,0 +1,21 @@
+import os
+import torch
+
+from background_evaluation import BackgroundEvaluator
+from PolicyNet import ExpertMixturePolicy, loadPolicy
+
+
+def test_checkpoints_are_saved_inline_after_the_evaluator_exited(mpc, tmp_path):
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM)
+    evaluator = BackgroundEvaluator(str(tmp_path / "logs"), 0.1, 1.0 / 400.)
+    evaluator.process.kill()
+    evaluator.process.join()
+
+    os.makedirs(str(tmp_path / "checkpoints"))
+    path = str(tmp_path / "checkpoints" / "policy.pt")
+    assert not evaluator.submit(1, policy, evaluate=True, checkpoint_path=path)
+    assert os.listdir(str(tmp_path / "checkpoints")) == ["policy.pt"]  # no temporary file left behind
+    saved = loadPolicy(path)
+    for param, saved_param in zip(policy.parameters(), saved.parameters()):
+        assert torch.equal(param, saved_param)
+    evaluator.close(timeout=1.0)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import torch
+
+from ballbot_evaluation import evaluationStartStates, rolloutCosts, trajectoryCost
+from PolicyNet import ExpertMixturePolicy
+
+
+class _FeedbackPolicy(object):
+    """Linear state feedback u = K x in the interface of the policies used by the rollouts."""
+
+    def __init__(self, K):
+        self.K = torch.tensor(K)
+
+    def action(self, tx):
+        return torch.matmul(tx[..., 1:].to(self.K.dtype), self.K.T)
+
+
+def test_lockstep_rollouts_match_sequential_euler(mpc):
+    torch.manual_seed(0)
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM).double()
+    x0 = evaluationStartStates(mpc, 4)
+    duration, dt = 0.5, 1.0 / 400.
+    cost, survival_time = rolloutCosts(mpc, policy, x0, duration, dt, dtype=torch.float64)
+
+    # one rollout after the other, with a policy call and a binding call per state and step
+    for k in range(len(x0)):
+        t, x, expected_cost = 0.0, x0[k].copy(), 0.0
+        for _ in range(int(duration / dt)):
+            with torch.no_grad():
+                u = policy.action(torch.tensor(np.concatenate(([t], x)))).numpy()
+            expected_cost += mpc.getIntermediateCost(t, x, u)
+            x = x + dt * np.reshape(mpc.computeFlowMap(t, x, u), -1)
+            t += dt
+        assert cost[k] == pytest.approx(expected_cost, rel=1e-12)
+        assert survival_time[k] == duration
+
+
+def test_diverged_rollouts_count_in_the_cost(mpc):
+    K = mpc.getLinearFeedbackGain(0.0)
+    oc_cost, survival_time, survival_fraction = trajectoryCost(mpc, _FeedbackPolicy(K), 2.0, 1.0 / 400., 24,
+                                                               dtype=torch.float64)
+    assert np.isfinite(oc_cost) and oc_cost > 0.0
+    assert survival_fraction == 1.0
+
+    # positive feedback only survives the equilibrium start, whose cost of zero must not become the score
+    oc_cost, survival_time, survival_fraction = trajectoryCost(mpc, _FeedbackPolicy(-100.0 * K), 2.0, 1.0 / 400., 24,
+                                                               dtype=torch.float64)
+    assert np.isnan(oc_cost)
+    assert survival_fraction == 1.0 / 24
+    assert survival_time < 2.0
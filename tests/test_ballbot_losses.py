@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+import torch
+
+from ballbot_losses import Hamiltonian, batch_loss_function, topKExperts
+from PolicyNet import ExpertMixturePolicy
+
+
+def _lossAndGradient(mpc, policy, samples, expert_mask=None):
+    """
+    Per-sample losses and the gradient of their sum, flattened over all policy parameters.
+    :param expert_mask: Optional function of the expert weights p returning the mask of the evaluated experts
+    """
+    t, x, dVdx, nu, u0 = samples
+    p, u_pred = policy(torch.cat((t.unsqueeze(1), x), dim=1))
+    if expert_mask is not None:
+        expert_mask = expert_mask(p)
+    sample_losses = batch_loss_function(mpc, t, x, p, u_pred, dVdx, nu, expert_mask)
+    policy.zero_grad()
+    sample_losses.sum().backward()
+    return sample_losses.detach(), torch.cat([param.grad.reshape(-1) for param in policy.parameters()])
+
+
+def test_hamiltonian_matches_bindings(mpc, memory):
+    t, x, dVdx, nu, u0 = memory.sample(16)
+    H = Hamiltonian.apply(mpc, t, x, u0, dVdx, nu)
+    for i in range(len(t)):
+        t_i, x_i, u_i = t[i].item(), x[i].numpy(), u0[i].numpy()
+        f = np.asarray(mpc.computeFlowMap(t_i, x_i, u_i)).reshape(-1)
+        assert H[i].item() == pytest.approx(mpc.getIntermediateCost(t_i, x_i, u_i) + dVdx[i].numpy().dot(f), rel=1e-12)
+
+
+def test_hamiltonian_input_gradient(mpc, memory):
+    t, x, dVdx, nu, u0 = memory.sample(8)
+    u = u0.clone().requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda u: Hamiltonian.apply(mpc, t, x, u, dVdx, nu), (u,), eps=1e-6, atol=1e-5)
+
+
+def test_batched_loss_matches_per_sample(mpc, memory):
+    torch.manual_seed(0)
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM).double()
+    samples = memory.sample(16)
+    sample_losses, gradient = _lossAndGradient(mpc, policy, samples)
+
+    gradient_sum = torch.zeros_like(gradient)
+    for i in range(len(samples.t)):
+        sample_loss, sample_gradient = _lossAndGradient(mpc, policy, samples._make(
+            None if column is None else column[i:i + 1] for column in samples))
+        assert torch.allclose(sample_loss[0], sample_losses[i], rtol=1e-12, atol=0.0)
+        gradient_sum += sample_gradient
+    assert torch.allclose(gradient_sum, gradient, rtol=1e-10, atol=1e-12)
+
+
+def test_all_experts_mask_matches_full_loss(mpc, memory):
+    torch.manual_seed(0)
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM).double()
+    samples = memory.sample(32)
+    sample_losses, gradient = _lossAndGradient(mpc, policy, samples)
+    masked_losses, masked_gradient = _lossAndGradient(mpc, policy, samples,
+                                                      lambda p: torch.ones(p.shape, dtype=torch.bool))
+    assert torch.allclose(masked_losses, sample_losses, rtol=1e-12, atol=0.0)
+    assert torch.allclose(masked_gradient, gradient, rtol=1e-10, atol=1e-12)
+
+    # a k as large as the number of experts selects all of them
+    top_losses, top_gradient = _lossAndGradient(mpc, policy, samples, lambda p: topKExperts(p, p.shape[1]))
+    assert torch.allclose(top_losses, sample_losses, rtol=1e-12, atol=0.0)
+    assert torch.allclose(top_gradient, gradient, rtol=1e-10, atol=1e-12)
+
+
+def test_top_k_gate_does_not_flatten(mpc, memory):
+    # trained on the top-2 experts only, the gate must still concentrate its weight like with the full loss
+    np.random.seed(1)
+    torch.manual_seed(1)
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM).double()
+    optimizer = torch.optim.Adam(policy.parameters(), lr=1e-2)
+    for _ in range(300):
+        t, x, dVdx, nu, u0 = memory.sample(32)
+        p, u_pred = policy(torch.cat((t.unsqueeze(1), x), dim=1))
+        loss = batch_loss_function(mpc, t, x, p, u_pred, dVdx, nu, topKExperts(p, 2)).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    t, x, dVdx, nu, u0 = memory.sample(1000)
+    with torch.no_grad():
+        p, _ = policy(torch.cat((t.unsqueeze(1), x), dim=1))
+    assert p.max(dim=1).values.mean().item() > 0.5  # 1/8 for a uniform gate
+
+
+def test_top_1_is_rejected():
+    # a single renormalized expert has a constant weight of one, the gate would get no gradient
+    with pytest.raises(ValueError):
+        topKExperts(torch.rand(4, 8), 1)
@@ -0,0 +1,35 @@
+import torch
+
+from ballbot_losses import Hamiltonian, batch_loss_function, topKExperts
+from data_parallel import DataParallelLoss
+from PolicyNet import ExpertMixturePolicy
+
+
+def test_data_parallel_matches_single_process(mpc, memory):
+    torch.manual_seed(0)
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM).double()
+    samples = memory.sample(33)  # not divisible by the number of processes
+    t, x, dVdx, nu, u0 = samples
+    weights = torch.rand(len(t), dtype=torch.float64)
+
+    data_parallel = DataParallelLoss(mpc, policy, 3, expert_top_k=2)
+    try:
+        for sample_weights in (None, weights):
+            policy.zero_grad()
+            p, u_pred = policy(torch.cat((t.unsqueeze(1), x), dim=1))
+            sample_losses = batch_loss_function(mpc, t, x, p, u_pred, dVdx, nu, topKExperts(p, 2))
+            loss = (sample_weights * sample_losses).sum() if sample_weights is not None else sample_losses.sum()
+            loss.backward()
+            gradients = [param.grad.clone() for param in policy.parameters()]
+            with torch.no_grad():
+                mpc_H = Hamiltonian.apply(mpc, t, x, u0, dVdx, nu)
+
+            parallel_loss, parallel_sample_losses, parallel_mpc_H = data_parallel.lossAndGradients(
+                samples, sample_weights, with_reference=True)
+            assert torch.allclose(parallel_loss, loss.detach(), rtol=1e-12, atol=0.0)
+            assert torch.allclose(parallel_sample_losses, sample_losses.detach(), rtol=1e-12, atol=0.0)
+            assert torch.allclose(parallel_mpc_H, mpc_H, rtol=1e-12, atol=0.0)
+            for param, gradient in zip(policy.parameters(), gradients):
+                assert torch.allclose(param.grad, gradient, rtol=1e-10, atol=1e-12)
+    finally:
+        data_parallel.close()
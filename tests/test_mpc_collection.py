@@ -0,0 +1,23 @@
+import pytest
+
+import mpc_collection
+from mpc_collection import CollectionWorkers
+from PolicyNet import ExpertMixturePolicy
+from replay_memory import ReplayMemory
+
+
+def test_drain_raises_once_all_workers_have_failed(mpc, monkeypatch):
+    def failingTrajectory(self, *args):
+        raise TypeError("failing trajectory")
+    monkeypatch.setattr(mpc_collection.CollectionEngine, "collectTrajectory", failingTrajectory)
+
+    collectors = CollectionWorkers(ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM), 2, 0.1, 1.0 / 400.,
+                                   max_consecutive_failures=2)
+    collectors.start()
+    mem = ReplayMemory(1000, mpc.STATE_DIM, mpc.INPUT_DIM)
+    try:
+        with pytest.raises(RuntimeError):
+            collectors.drain(mem, block=True, timeout=0.1)
+    finally:
+        collectors.stop()
+    assert len(mem) == 0
@@ -0,0 +1,155 @@
+import numpy as np
+
+from replay_memory import PrioritizedReplayMemory, ReplayMemory, SumTree
+
+STATE_DIM = 3
+INPUT_DIM = 2
+
+
+def _block(t):
+    """Samples whose columns are all derived from their times t, so that rows can be recognized."""
+    t = np.asarray(t, dtype=np.float64)
+    x = t[:, None] + np.arange(STATE_DIM)
+    return t, x, -x, None, t[:, None] * np.ones(INPUT_DIM)
+
+
+def _assertRows(mem, indices, t):
+    expected = _block(t)
+    np.testing.assert_array_equal(mem.t[indices], expected[0])
+    np.testing.assert_array_equal(mem.x[indices], expected[1])
+    np.testing.assert_array_equal(mem.dVdx[indices], expected[2])
+    np.testing.assert_array_equal(mem.u0[indices], expected[4])
+
+
+def test_push_wraps_around():
+    mem = ReplayMemory(10, STATE_DIM, INPUT_DIM, dtype=np.float64)
+    mem.push_batch(*_block(np.arange(4)))
+    indices = mem.push_batch(*_block(np.arange(100, 106)))
+    np.testing.assert_array_equal(indices, [4, 5, 6, 7, 8, 9])
+    indices = mem.push_batch(*_block(np.arange(200, 203)))
+    np.testing.assert_array_equal(indices, [0, 1, 2])
+    assert len(mem) == 10 and mem.position == 3
+    _assertRows(mem, np.arange(10), [200, 201, 202, 3, 100, 101, 102, 103, 104, 105])
+
+
+def test_push_of_block_larger_than_capacity_keeps_its_latest_rows():
+    mem = ReplayMemory(10, STATE_DIM, INPUT_DIM, dtype=np.float64)
+    mem.push_batch(*_block(np.arange(4)))
+    indices = mem.push_batch(*_block(np.arange(100, 125)))
+    np.testing.assert_array_equal(indices, (4 + np.arange(10)) % 10)
+    assert len(mem) == 10 and mem.position == 4
+    _assertRows(mem, indices, np.arange(115, 125))
+
+
+def test_push_drops_rows_with_nan():
+    mem = ReplayMemory(10, STATE_DIM, INPUT_DIM, constraint_dim=1, dtype=np.float64)
+    t, x, dVdx, _, u0 = _block(np.arange(6))
+    nu = np.zeros((6, 1))
+    x[1, 2] = np.nan
+    u0[3, 0] = np.nan
+    nu[5, 0] = np.nan
+    indices = mem.push_batch(t, x, dVdx, nu, u0)
+    np.testing.assert_array_equal(indices, [0, 1, 2])
+    assert len(mem) == 3
+    _assertRows(mem, indices, [0, 2, 4])
+
+
+def test_disk_backed_memory_reopens(tmp_path):
+    path = str(tmp_path / "memory")
+    mem = ReplayMemory(10, STATE_DIM, INPUT_DIM, dtype=np.float64, path=path)
+    mem.push_batch(*_block(np.arange(6)))
+    mem.flush()
+
+    reopened = ReplayMemory.load(path)
+    assert isinstance(reopened.x, np.memmap) and reopened.x.mode == 'r+'
+    assert len(reopened) == 6 and reopened.position == 6
+    _assertRows(reopened, np.arange(6), np.arange(6))
+    reopened.push_batch(*_block(np.arange(100, 106)))  # written through to the files
+    reopened.flush()
+    del reopened
+
+    mem = ReplayMemory.load(path)
+    assert len(mem) == 10 and mem.position == 2
+    _assertRows(mem, np.arange(10), [104, 105, 2, 3, 4, 5, 100, 101, 102, 103])
+
+
+def test_copied_memory_is_independent_of_its_files(tmp_path):
+    path = str(tmp_path / "memory")
+    mem = ReplayMemory(10, STATE_DIM, INPUT_DIM, dtype=np.float64)
+    mem.push_batch(*_block(np.arange(6)))
+    mem.save(path)
+
+    copied = ReplayMemory.load(path, copy=True)
+    assert copied.path is None and not isinstance(copied.x, np.memmap)
+    _assertRows(copied, np.arange(6), np.arange(6))
+    copied.push_batch(*_block(np.arange(100, 106)))
+    copied.flush()
+    copied.save(str(tmp_path / "other"))
+
+    mem = ReplayMemory.load(path)
+    assert len(mem) == 6
+    _assertRows(mem, np.arange(6), np.arange(6))
+
+
+def test_sum_tree_find_and_update():
+    tree = SumTree(5)  # padded to 8 leaves, the last 3 stay empty
+    tree.update(np.arange(5), [1.0, 0.0, 2.0, 0.0, 3.0])
+    assert tree.total() == 6.0
+    np.testing.assert_array_equal(tree.find([0.0, 0.99, 1.0, 2.99, 3.0, 5.99]), [0, 0, 2, 2, 4, 4])
+    # values rounded up to the total must not end on an empty leaf
+    np.testing.assert_array_equal(tree.find([6.0, 6.0 + 1e-9]), [4, 4])
+
+    tree.update([1, 3, 1], [5.0, 0.5, 7.0])  # the last value of a duplicate index wins
+    np.testing.assert_array_equal(tree[np.arange(5)], [1.0, 7.0, 2.0, 0.5, 3.0])
+    assert tree.total() == 13.5
+    tree.update([], [])
+    assert tree.total() == 13.5
+
+
+def _prioritizedMemory(priorities, **kwargs):
+    mem = PrioritizedReplayMemory(len(priorities), STATE_DIM, INPUT_DIM, dtype=np.float64, alpha=1.0, epsilon=0.0,
+                                  **kwargs)
+    indices = mem.push_batch(*_block(np.arange(len(priorities))))
+    mem.update_priorities(indices, np.asarray(priorities))
+    return mem
+
+
+def test_prioritized_sampling_is_proportional_to_priority():
+    np.random.seed(0)
+    priorities = np.array([1.0, 2.0, 0.0, 5.0])
+    mem = _prioritizedMemory(priorities, beta=0.5)
+    counts = np.zeros(len(priorities))
+    for _ in range(2000):
+        samples, indices, weights = mem.sample_prioritized(16)
+        np.testing.assert_array_equal(samples.t.numpy(), indices)  # the times are the row indices
+        expected_weights = (len(mem) * priorities[indices] / priorities.sum()) ** -0.5
+        np.testing.assert_allclose(weights.numpy(), expected_weights / expected_weights.max())
+        np.add.at(counts, indices, 1)
+    np.testing.assert_allclose(counts / counts.sum(), priorities / priorities.sum(), atol=0.01)
+
+
+def test_new_samples_enter_at_max_priority():
+    mem = _prioritizedMemory([1.0, 8.0, 3.0, 2.0])
+    indices = mem.push_batch(*_block([100.0, 101.0]))
+    np.testing.assert_array_equal(indices, [0, 1])
+    np.testing.assert_array_equal(mem.priorities[np.arange(4)], [8.0, 8.0, 3.0, 2.0])
+
+
+def test_priorities_survive_save_and_load(tmp_path):
+    priorities = [1.0, 8.0, 3.0, 2.0]
+    mem = _prioritizedMemory(priorities)
+    mem.save(str(tmp_path / "saved"))
+    loaded = PrioritizedReplayMemory.load(str(tmp_path / "saved"))
+    np.testing.assert_array_equal(loaded.priorities[np.arange(4)], priorities)
+    assert loaded.max_priority == 8.0
+
+    # disk-backed: the columns are reopened in place, size, position and priorities come from the snapshot
+    mem = _prioritizedMemory(priorities, path=str(tmp_path / "columns"))
+    mem.flush()
+    mem.saveMeta(str(tmp_path / "meta"))
+    mem.push_batch(*_block([100.0]))
+    mem.update_priorities([0], [20.0])
+    mem.flush()
+    loaded = PrioritizedReplayMemory.load(str(tmp_path / "columns"), meta_path=str(tmp_path / "meta"))
+    assert len(loaded) == 4 and loaded.position == 0
+    np.testing.assert_array_equal(loaded.priorities[np.arange(4)], priorities)
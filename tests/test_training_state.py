@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+import torch
+
+import training_state
+from PolicyNet import ExpertMixturePolicy
+from replay_memory import ReplayMemory
+from training_state import loadTrainingState, saveTrainingState
+
+
+def _trainingState(mpc):
+    policy = ExpertMixturePolicy(mpc.STATE_DIM + 1, mpc.INPUT_DIM)
+    optimizer = torch.optim.Adam(policy.parameters())
+    mem = ReplayMemory(100, mpc.STATE_DIM, mpc.INPUT_DIM)
+    mem.push_batch(np.zeros(5), np.ones((5, mpc.STATE_DIM)), np.ones((5, mpc.STATE_DIM)), None,
+                   np.ones((5, mpc.INPUT_DIM)))
+    return policy, optimizer, mem
+
+
+def test_save_recovers_from_interrupted_saves(mpc, tmp_path, monkeypatch):
+    policy, optimizer, mem = _trainingState(mpc)
+    path = str(tmp_path / "state")
+    os.makedirs(path + ".mem")  # unrelated sibling, e.g. a disk-backed replay memory
+    saveTrainingState(path, policy, optimizer, 1, mem)
+
+    # one save interrupted between symlink() and replace(), one while its directory was written
+    os.symlink("missing", path + ".tmp")
+    os.makedirs(path + ".2020-01-01_000000_000000")
+    with monkeypatch.context() as patch:
+        def interruptedSave(*args, **kwargs):
+            raise KeyboardInterrupt
+        patch.setattr(training_state.torch, "save", interruptedSave)
+        with pytest.raises(KeyboardInterrupt):
+            saveTrainingState(path, policy, optimizer, 2, mem)
+    assert loadTrainingState(path, policy, optimizer, ReplayMemory)[0] == 1
+
+    state_dir = saveTrainingState(path, policy, optimizer, 3, mem)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["state", "state.mem", os.path.basename(state_dir)])
+    next_iteration, resumed_mem = loadTrainingState(path, policy, optimizer, ReplayMemory)
+    assert next_iteration == 3 and len(resumed_mem) == 5
+
+
+def test_interrupted_atomic_write_keeps_the_previous_file(tmp_path):
+    path = str(tmp_path / "meta.json")
+    training_state.atomicWrite(path, lambda tmp_path: open(tmp_path, 'w').write("old"))
+
+    def interrupted(tmp_path):
+        open(tmp_path, 'w').write("trunc")
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        training_state.atomicWrite(path, interrupted)
+    assert os.listdir(str(tmp_path)) == ["meta.json"]
+    assert open(path).read() == "old"
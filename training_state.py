@@ -0,0 +1,107 @@
+"""
+Complete training checkpoints, from which an interrupted run of the learner continues where it stopped.
+
+A training state is a directory holding state.pt (policy snapshot, optimizer state, next iteration and RNG
+states) and the replay memory in the format of ReplayMemory.save(). The columns of disk-backed memories are
+flushed and referenced instead of copied, only their size, position and priorities are saved with the state.
+They are memory-mapped again when the state is loaded, rows that were pushed after the state was saved may
+then have replaced older samples.
+The directory is reached through a symlink that is swapped atomically once a new state is completely
+written, so an interruption while saving always leaves the previous state intact.
+"""
+import datetime
+import os
+import re
+import shutil
+import numpy as np
+import torch
+
+from PolicyNet import policySnapshot
+
+
+def atomicWrite(path, write):
+    """
+    Writes a file through write(tmp_path) to a temporary file that is then renamed to path,
+    so that an interrupted write never leaves a truncated file at path behind.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _stateDirs(path):
+    """Directories of the states written to path so far, whether completed or not."""
+    pattern = re.compile(re.escape(os.path.basename(path)) + r"\.\d{4}-\d{2}-\d{2}_\d{6}_\d{6}")
+    parent = os.path.dirname(os.path.abspath(path))
+    return [os.path.join(parent, name) for name in os.listdir(parent)
+            if pattern.fullmatch(name) and os.path.isdir(os.path.join(parent, name))]
+
+
+def saveTrainingState(path, policy, optimizer, next_iteration, mem):
+    """
+    Writes the training state to a new directory next to path and then points the symlink path to it.
+    Afterwards, the directories of earlier states, including those of interrupted saves, are removed.
+    :param next_iteration: Iteration a resumed run starts with
+    """
+    state_dir = path + "." + datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S_%f")
+    try:
+        os.makedirs(state_dir)
+        if mem.path is None:
+            mem.save(os.path.join(state_dir, "memory"))
+            memory_path = "memory"
+        else:
+            mem.flush()
+            mem.saveMeta(os.path.join(state_dir, "memory"))
+            memory_path = os.path.abspath(mem.path)
+        state = {
+            "policy": policySnapshot(policy),
+            "optimizer": optimizer.state_dict(),
+            "next_iteration": next_iteration,
+            "memory_path": memory_path,
+            "numpy_rng": np.random.get_state(),
+            "torch_rng": torch.get_rng_state(),
+            "cuda_rng": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        }
+        torch.save(state, os.path.join(state_dir, "state.pt"))
+
+        if os.path.lexists(path + ".tmp"):
+            os.remove(path + ".tmp")  # left behind by a save interrupted between symlink() and replace()
+        os.symlink(os.path.basename(state_dir), path + ".tmp")
+        os.replace(path + ".tmp", path)
+    except BaseException:  # also Ctrl-C and SIGTERM, the previous state stays the current one
+        shutil.rmtree(state_dir, ignore_errors=True)
+        raise
+
+    current_dir = os.path.realpath(state_dir)
+    for stale_dir in _stateDirs(path):
+        if os.path.realpath(stale_dir) != current_dir:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+    return state_dir
+
+
+def loadTrainingState(path, policy, optimizer, memory_class):
+    """
+    Restores the policy weights, the optimizer state and the RNG states saved to path.
+    :param memory_class: ReplayMemory class whose load() opens the saved memory
+    :return: (iteration to continue with, replay memory)
+    """
+    # the state holds numpy RNG states and is written by us, so it may be fully unpickled
+    state = torch.load(os.path.join(path, "state.pt"), map_location="cpu", weights_only=False)
+    policy.load_state_dict(state["policy"]["state_dict"])
+    optimizer.load_state_dict(state["optimizer"])
+    memory_path = state["memory_path"]
+    if os.path.isabs(memory_path):
+        mem = memory_class.load(memory_path, meta_path=os.path.join(path, "memory"))
+    else:
+        # a copy saved with the state is read into RAM, it must stay untouched in case the state is resumed again
+        mem = memory_class.load(os.path.join(path, memory_path), copy=True)
+    np.random.set_state(state["numpy_rng"])
+    torch.set_rng_state(state["torch_rng"])
+    if state["cuda_rng"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda_rng"])
+    return state["next_iteration"], mem